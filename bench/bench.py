@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+bench.py
+-----
+Benchmark for Bass: generate a synthetic site, time builds, record results.
+
+The synthetic site has a configurable number of pages (page types .mkd, .rst, .txt), spread
+over a tree of folders, with tags, idref links between pages, assets, and an index page with a
+paginated table of contents. The following scenarios are timed:
+
+    - cold: full build in a new process, without cache and output
+    - warm: full build in a new process, with cache
+    - noop: incremental build without changes
+    - incremental: incremental build after changing one page
+    - rebuild: rebuild as done by the development server after changing one page
+    - startup: start of the bass command (bass --version) in a new process
+    - import: import of the bass package in a new process
+
+Each scenario is run several times (option --repeat); the minimum and median are reported.
+The results are appended as one JSON object per line to a results file, together with the
+versions of Bass (with the git commit) and Python, so that results of different versions can be
+compared.
+
+Usage: python bench/bench.py --pages 1000 --assets 50
+"""
+
+import argparse, json, platform, random, re, shutil, statistics, subprocess, sys, tempfile, time
+from os import environ, makedirs
+from os.path import abspath, dirname, join
+
+source_dir = abspath(join(dirname(__file__), '..', 'src'))
+script = join(source_dir, 'script', 'bass')
+
+words = '''lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor
+incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud exercitation
+ullamco laboris nisi aliquip ex ea commodo consequat'''.split()
+
+default_template = '''<!doctype html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:tal="http://xml.zope.org/namespaces/tal">
+  <head><title>${this.title}</title></head>
+  <body>
+    <h1>${this.title}</h1>
+    <div tal:content="structure this.content"></div>
+    <div tal:condition="exists: this.toc" tal:content="structure this.toc"></div>
+  </body>
+</html>
+'''
+
+entry_template = '''<div><a href="${this.url}">${this.title}</a> ${structure: this.preview}</div>
+'''
+
+extension = '''from bass import add_handler, add_toc, resolve_idref
+def index(this):
+    add_toc(this, this.root().pages(tag='tag0', deep=True), skin='entry', size=20)
+add_handler('render:pre:page:name:index.mkd', index)
+add_handler('render:pre:page:any', resolve_idref)
+'''
+
+def paragraph(rnd, n=60):
+    """random paragraph of n words"""
+    return ' '.join(rnd.choice(words) for _ in range(n)).capitalize() + '.'
+
+def link(kind, target):
+    """idref link to page with id 'target' in markup of given kind"""
+    if kind == 'mkd':
+        return f'[{target}](idref:{target})'
+    elif kind == 'rst':
+        return f'`{target} <idref:{target}>`_'
+    else:
+        return f'see {target}'
+
+def folders(depth, width):
+    """list of relative folder paths of a tree with given depth and width"""
+    result, level = [''], ['']
+    for _ in range(depth):
+        level = [join(parent, f'd{i}') for parent in level for i in range(width)]
+        result.extend(level)
+    return result
+
+def generate(project, args):
+    """generate synthetic site in project directory"""
+    rnd = random.Random(args.seed)
+    content = join(project, 'content')
+    for name in ('content', 'layout', 'output', 'ext'):
+        makedirs(join(project, name), exist_ok=True)
+    with open(join(project, 'config'), 'w') as f:
+        f.write('input: content\nextension: ext\n')
+    with open(join(project, 'layout', 'default.xml'), 'w') as f:
+        f.write(default_template)
+    with open(join(project, 'layout', 'entry.xml'), 'w') as f:
+        f.write(entry_template)
+    with open(join(project, 'ext', '__init__.py'), 'w') as f:
+        f.write(extension)
+    paths = folders(args.depth, args.width)
+    for path in paths:
+        makedirs(join(content, path), exist_ok=True)
+    types = args.types.split(',')
+    for i in range(args.pages):
+        kind = types[i % len(types)]
+        tags = ' '.join(f'tag{t}' for t in rnd.sample(range(args.tags), min(3, args.tags)))
+        links = ' '.join(link(kind, f'p{rnd.randrange(args.pages)}') for _ in range(args.links))
+        body = '\n\n'.join(paragraph(rnd) for _ in range(5))
+        with open(join(content, paths[i % len(paths)], f'page{i}.{kind}'), 'w') as f:
+            f.write(f'title: Page {i}\ntags: {tags}\nid: p{i}\n---\n{paragraph(rnd, 30)}\n---\n'
+                    f'{body}\n\n{links}\n')
+    with open(join(content, 'index.mkd'), 'w') as f:
+        f.write('title: Index\n---\nIndex of pages with tag0.\n')
+    for i in range(args.assets):
+        with open(join(content, paths[i % len(paths)], f'asset{i}.png'), 'wb') as f:
+            # Random.randbytes needs Python 3.9
+            f.write(rnd.getrandbits(8 * args.asset_size).to_bytes(args.asset_size, 'little')
+                    if args.asset_size else b'')
+
+def run(project, options):
+    """run build in new process, return wall time in seconds"""
+    env = dict(environ, PYTHONPATH=source_dir)
+    start = time.perf_counter()
+    subprocess.run([sys.executable, script, '-b'] + options, cwd=project, env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+rebuild_code = '''
+import json, sys, time
+from bass import setting
+from bass.site import build_site, rebuild_site
+setting.args = None
+build_site()
+with open(sys.argv[1], 'a') as f:
+    f.write('\\nChanged.\\n')
+start = time.perf_counter()
+rebuild_site({sys.argv[1]})
+print(json.dumps(time.perf_counter() - start))
+'''
+
+def run_rebuild(project, changed):
+    """build site, change one page, time rebuild as done by the development server"""
+    env = dict(environ, PYTHONPATH=source_dir)
+    result = subprocess.run([sys.executable, '-c', rebuild_code, changed], cwd=project, env=env,
+                            check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return json.loads(result.stdout.decode().strip().splitlines()[-1])
+
+def run_startup(project, code=None):
+    """run 'bass --version' (or the given Python code) in new process, return wall time"""
+    env = dict(environ, PYTHONPATH=source_dir)
+    command = [sys.executable, '-c', code] if code else [sys.executable, script, '--version']
+    start = time.perf_counter()
+    subprocess.run(command, cwd=project, env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+def touch_page(project, args, n):
+    """change content of one page, return its path"""
+    path = join(project, 'content', folders(args.depth, args.width)[0], f'page0.{args.types.split(",")[0]}')
+    with open(path, 'a') as f:
+        f.write(f'\nChange {n}.\n')
+    return path
+
+def benchmark(project, args):
+    """run all scenarios, return results as dictionary"""
+    options = ['-j', str(args.jobs)] + (['--lazy'] if args.lazy else [])
+    times = {name: [] for name in ('cold', 'warm', 'noop', 'incremental', 'rebuild',
+                                   'startup', 'import')}
+    for n in range(args.repeat):
+        times['startup'].append(run_startup(project))
+        times['import'].append(run_startup(project, 'import bass'))
+        shutil.rmtree(join(project, '.bass'), ignore_errors=True)
+        shutil.rmtree(join(project, 'output'))
+        makedirs(join(project, 'output'))
+        times['cold'].append(run(project, options))
+        times['warm'].append(run(project, options))
+        times['noop'].append(run(project, options + ['-i']))
+        touch_page(project, args, n)
+        times['incremental'].append(run(project, options + ['-i']))
+        times['rebuild'].append(run_rebuild(project, touch_page(project, args, n)))
+    return {name: dict(min=round(min(t), 4), median=round(statistics.median(t), 4))
+            for name, t in times.items()}
+
+def bass_version():
+    """version of the benchmarked Bass tree: version in pyproject.toml, and the commit (with
+       '-dirty' for local changes) if the tree is a git repository"""
+    version = 'unknown'
+    with open(join(source_dir, '..', 'pyproject.toml')) as f:
+        found = re.search(r"^version\s*=\s*['\"]([^'\"]*)['\"]", f.read(), re.MULTILINE)
+    if found:
+        version = found.group(1)
+    try:
+        commit = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=source_dir,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError): # no git, or not a repository
+        return version
+    return f'{version} ({commit})'
+
+def parse_cmdline():
+    parser = argparse.ArgumentParser(description='Benchmark for Bass')
+    parser.add_argument('--pages',      type=int, default=1000, help='number of pages')
+    parser.add_argument('--depth',      type=int, default=2,    help='depth of folder tree')
+    parser.add_argument('--width',      type=int, default=4,    help='sub-folders per folder')
+    parser.add_argument('--tags',       type=int, default=20,   help='number of different tags')
+    parser.add_argument('--links',      type=int, default=3,    help='idref links per page')
+    parser.add_argument('--assets',     type=int, default=20,   help='number of assets')
+    parser.add_argument('--asset-size', type=int, default=10000, help='size of asset in bytes')
+    parser.add_argument('--types',      default='mkd',          help='page types, e.g. mkd,rst,txt')
+    parser.add_argument('--jobs',       type=int, default=1,    help='number of rendering processes')
+    parser.add_argument('--lazy',       action='store_true',    help='lazy loading of pages')
+    parser.add_argument('--repeat',     type=int, default=3,    help='number of runs per scenario')
+    parser.add_argument('--seed',       type=int, default=1,    help='seed for random generator')
+    parser.add_argument('--dir',        default=None,           help='project directory (default: temporary)')
+    parser.add_argument('--results',    default='bench-results.jsonl', help='file to append results to')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_cmdline()
+    project = args.dir or tempfile.mkdtemp(prefix='bass-bench-')
+    generate(project, args)
+    results = benchmark(project, args)
+    if not args.dir:
+        shutil.rmtree(project)
+    record = dict(version=bass_version(), python=platform.python_version(),
+                  date=time.strftime('%Y-%m-%d %H:%M:%S'), parameters=vars(args), results=results)
+    for name, result in results.items():
+        print(f'{name:12} min {result["min"]:8.3f}s  median {result["median"]:8.3f}s')
+    with open(args.results, 'a') as f:
+        f.write(json.dumps(record) + '\n')
@@ -19,12 +19,16 @@ Functions:
     - logger: logging object
     - resolve_idref: event handler for resolving idref notation
     - add_toc: helper function for creating event handler
+    - add_rewriter: add rewriter (pattern and replacement) for the HTML of pages
+    - depend: record dependency of a node on another input (for incremental builds)
+    - dependents: outputs of the previous build that depend on the given input files
 """
 
 from .common  import logger
 from .config  import parse_cmdline
-from .event   import add_toc, add_handler, copy_handler, remove_handler, resolve_idref
+from .event   import add_rewriter, add_toc, add_handler, copy_handler, remove_handler, resolve_idref
 from .layout  import add_template_type, copy_template_type
+from .manifest import depend, dependents
 from .server  import http_server
 from .site    import build_site, create_project
 from .tree    import add_transformer
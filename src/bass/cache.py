@@ -0,0 +1,87 @@
+"""
+bass.cache
+-----
+Objects and functions related to persistent caches.
+
+A cache is a sub-directory of the cache directory (see configuration), in which every entry is a
+file with the key as name. Keys are hexadecimal digests, values are byte strings. When an entry
+is used, its modification time is updated, so that the least recently used entries can be
+removed when the size of a cache exceeds the limit defined by the configuration option
+'cache_size' (in megabytes). If this limit is 0, caching is disabled.
+"""
+
+from os import makedirs, replace, scandir, unlink, utime, getpid
+from threading import get_ident
+from os.path import join
+from . import setting
+from .common import logger
+
+class Cache:
+    """persistent key-value store in a sub-directory of the cache directory"""
+    def __init__(self, name):
+        """create cache with given name"""
+        self.name = name
+        self.directory = join(setting.cache, name)
+
+    def path(self, key):
+        """path of entry with given key"""
+        return join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """return value of entry with given key, or None"""
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = f.read()
+        except OSError:
+            return None
+        utime(path)
+        return value
+
+    def put(self, key, value):
+        """store value under given key"""
+        path = self.path(key)
+        makedirs(join(self.directory, key[:2]), exist_ok=True)
+        # write to temporary file first, since other processes may read the same entry; the
+        # name is unique per thread, since transformer threads may store the same entry
+        temp_path = f'{path}.{getpid()}.{get_ident()}'
+        with open(temp_path, 'wb') as f:
+            f.write(value)
+        replace(temp_path, path)
+
+    def evict(self, limit):
+        """remove least recently used entries until total size is at most 'limit' bytes"""
+        entries = []
+        for item in scandir(self.directory):
+            # entries are files in sub-directories (Cache) or in the cache directory itself
+            for entry in (scandir(item.path) if item.is_dir() else [item]):
+                info = entry.stat()
+                entries.append((info.st_mtime, info.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        if total <= limit:
+            return
+        logger.debug(f'Cache {self.name}: {total} bytes, limit {limit} bytes')
+        for _, size, path in sorted(entries):
+            unlink(path)
+            total -= size
+            if total <= limit:
+                break
+
+# open caches, with name as key
+caches = {}
+
+def open_cache(name):
+    """return cache with given name, or None if caching is disabled"""
+    if not setting.cache_size:
+        return None
+    if name not in caches or caches[name].directory != join(setting.cache, name):
+        caches[name] = Cache(name)
+    return caches[name]
+
+def evict_caches():
+    """keep size of each open cache within the limit"""
+    for cache in caches.values():
+        try:
+            cache.evict(setting.cache_size * 2**20)
+        except OSError as e:
+            logger.debug(f'Cache {cache.name} cannot be cleaned: {e}')
@@ -16,14 +16,20 @@ Webob and Waitress available:
 Waitress uses a logger object named 'waitress', and sets the logging level to WARNING.
 """
 
-import logging
+import logging, shutil
+from hashlib import sha1
+from importlib.util import find_spec
+from os import getpid, link, replace, stat, utime
 # configure logging
 logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
-try:
-    import waitress
-    logger = logging.getLogger('waitress')
-except ImportError:
-    logger = logging.getLogger('bass')
+def available(name):
+    """True if the module with given name can be imported (without importing it)"""
+    try:
+        return find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
+logger = logging.getLogger('waitress' if available('waitress') else 'bass')
 
 from yaml import load
 try:
@@ -33,9 +39,9 @@ except ImportError:
 
 def read_file(filename):
     """read entire file, return content as one string"""
-    with open(filename, 'rU') as f:
+    with open(filename, 'r') as f:
         try:
-            text = ''.join(f.readlines())
+            text = f.read()
         except UnicodeError:
             text = ''
             logger.debug(f'Unicode error in file {filename}')
@@ -56,3 +62,78 @@ def read_yaml_string(string):
     """read string, return YAML content as dictionary"""
     result = load(string, Loader=Loader)
     return result
+
+def hash_string(text):
+    """return SHA-1 digest of text, as hexadecimal string"""
+    return sha1(text.encode('utf-8')).hexdigest()
+
+def hash_file(path, blocksize=1<<16):
+    """return SHA-1 digest of file content, as hexadecimal string"""
+    digest = sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def same_file(source, target):
+    """True if target exists and has the same content as source: same inode, or same size and
+       modification time, or same size and content (then the modification time is corrected)"""
+    try:
+        t = stat(target)
+    except OSError:
+        return False
+    s = stat(source)
+    if (s.st_dev, s.st_ino) == (t.st_dev, t.st_ino):
+        return True
+    if s.st_size != t.st_size:
+        return False
+    if s.st_mtime_ns == t.st_mtime_ns:
+        return True
+    if hash_file(source) == hash_file(target):
+        utime(target, ns=(s.st_atime_ns, s.st_mtime_ns))
+        return True
+    return False
+
+FICLONE = 0x40049409 # ioctl request for reflink (Linux: btrfs, xfs)
+
+def copy_data(fsrc, fdst, reflink=False):
+    """copy file data, preferably without passing it through user space"""
+    if reflink:
+        try:
+            import fcntl
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return
+        except (ImportError, OSError):
+            logger.debug(f'Reflink not possible for {fdst.name}')
+    try:
+        from os import copy_file_range
+        while copy_file_range(fsrc.fileno(), fdst.fileno(), 1<<30) > 0:
+            pass
+        return
+    except (ImportError, OSError):
+        pass
+    fsrc.seek(0)
+    fdst.seek(0)
+    fdst.truncate()
+    shutil.copyfileobj(fsrc, fdst)
+
+def copy_file(source, target, mode='copy'):
+    """copy source to target, unless target has the same content as source;
+       mode is 'copy', 'link' (hard link) or 'reflink' (copy-on-write clone)"""
+    if same_file(source, target):
+        logger.debug(f'File {target} is identical to {source}')
+        return
+    temp = f'{target}.{getpid()}.tmp'
+    if mode == 'link':
+        try:
+            link(source, temp)
+            replace(temp, target)
+            return
+        except OSError: # e.g. different file systems
+            logger.debug(f'Hard link not possible for {target}')
+    with open(source, 'rb') as fsrc, open(temp, 'wb') as fdst:
+        copy_data(fsrc, fdst, reflink=(mode == 'reflink'))
+    shutil.copymode(source, temp)
+    info = stat(source)
+    utime(temp, ns=(info.st_atime_ns, info.st_mtime_ns))
+    replace(temp, target)
@@ -12,7 +12,10 @@ from .common import read_yaml_file
 
 config_default = dict(follow_links=False, ignore='.?*',
                       host='localhost', port=8080, root_url='/',
-                      input='input', output='output', layout='layout')
+                      input='input', output='output', layout='layout',
+                      cache='.bass', cache_size=100, incremental=False, jobs=1,
+                      lazy=False, meta_cache=False, profile=None, asset_copy='copy',
+                      transform_jobs=4, write_jobs=4, compress=False)
 
 def read_config():
     """read configuration file, define global settings"""
@@ -20,17 +23,33 @@ def read_config():
     config = config_default.copy()
     if exists(config_file) and isfile(config_file):
         config.update(read_yaml_file(config_file))
+    # options given on the command line override the configuration file
+    args = vars(setting.args) if setting.args else {}
+    for key in config_default:
+        if args.get(key) is not None:
+            config[key] = args[key]
     setting.follow_links  = config['follow_links']
     setting.ignore = config['ignore'].split()
     setting.host = config['host']
     setting.port = config['port']
     setting.root_url = config['root_url']
+    setting.asset_copy = config['asset_copy']
+    setting.transform_jobs = config['transform_jobs']
+    setting.write_jobs = config['write_jobs']
+    setting.compress = config['compress']
     if config_default['ignore'] not in setting.ignore:
         setting.ignore.append(config_default['ignore'])
     setting.project = getcwd()
     setting.input   = join(setting.project, config['input'])
     setting.layout  = join(setting.project, config['layout'])
     setting.output  = join(setting.project, config['output'])
+    setting.cache   = join(setting.project, config['cache'])
+    setting.cache_size = config['cache_size']
+    setting.incremental = config['incremental']
+    setting.jobs = config['jobs']
+    setting.lazy = config['lazy']
+    setting.meta_cache = config['meta_cache']
+    setting.profile = join(setting.project, config['profile']) if config['profile'] else None
     if 'extension' in config:
         setting.extension = config['extension']
 
@@ -42,4 +61,11 @@ def parse_cmdline():
     parser.add_argument('-c', '--create',  help='create',  action='store_true', default=False)
     parser.add_argument('-d', '--debug',   help='debug',   action='store_true', default=False)
     parser.add_argument('-s', '--server',  help='server',  action='store_true')
+    parser.add_argument('--daemon',        help='build daemon: build site on request of bass --build',
+                        action='store_true', default=False)
+    parser.add_argument('-i', '--incremental', help='incremental build', action='store_true', default=None)
+    parser.add_argument('-j', '--jobs',    help='number of rendering processes', type=int, default=None)
+    parser.add_argument('-l', '--lazy',    help='load page content when needed', action='store_true', default=None)
+    parser.add_argument('-p', '--profile', help='write profile of build to file (default: profile.json)',
+                        nargs='?', const='profile.json', default=None)
     return parser.parse_args()
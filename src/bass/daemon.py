@@ -0,0 +1,146 @@
+"""
+bass.daemon
+-----
+Build daemon: a process that builds the site on request, for projects that are built often
+(e.g. by continuous integration).
+
+The daemon (bass --daemon) builds the site once, and then waits for requests on a Unix socket in
+the cache directory. Because the process keeps running, the Python packages (converters,
+Chameleon), the extension and the compiled templates are loaded only once, and the caches stay
+open. Pages that have been read and converted are kept in memory, and are only read again if
+they have changed. 'bass --build' sends its options to the daemon if there is one for the
+project, and prints the log messages that the daemon sends back while it builds the site;
+otherwise it builds the site itself. Requests are handled one at a time.
+
+The extension cannot be loaded again in a running process: if it has changed, the daemon stops,
+and the site is built by the client.
+
+Protocol: the client sends one line with a JSON object (options), the daemon sends a JSON object
+per line: {"log": message} for every log message, and finally {"done": true, "ok": boolean}.
+"""
+
+import json, logging, signal, socket, sys
+from argparse import Namespace
+from os import unlink
+from os.path import exists, join
+from . import setting
+from .common import logger
+from .config import read_config
+from .manifest import extension_digest
+from .site import build_site, keep_pages
+
+# options of the command line that are passed to the daemon
+options = ('incremental', 'jobs', 'lazy', 'profile')
+
+def socket_path():
+    """path of the Unix socket of the build daemon of the project"""
+    return join(setting.cache, 'daemon.sock')
+
+class ClientHandler(logging.Handler):
+    """log handler that sends log messages to the client"""
+    def __init__(self, stream):
+        super().__init__()
+        self.stream = stream
+        self.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+
+    def emit(self, record):
+        try:
+            self.stream.write(json.dumps(dict(log=self.format(record))) + '\n')
+            self.stream.flush()
+        except OSError: # client has gone, finish build anyway
+            pass
+
+def serve_daemon():
+    """build site, then build it again for every request on the socket of the project"""
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0)) # remove socket when killed
+    keep_pages()
+    build_site()
+    digest = extension_digest()
+    path = socket_path()
+    if exists(path): # left by a daemon that was killed
+        unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(path)
+        server.listen()
+        logger.info(f'Build daemon listening on {path}')
+        while True:
+            connection, _ = server.accept()
+            with connection, connection.makefile('rw') as stream:
+                if not handle_request(stream, digest):
+                    logger.info('Extension changed, stopping build daemon')
+                    break
+    finally:
+        server.close()
+        unlink(path)
+
+def handle_request(stream, digest):
+    """build site with the options of the request in 'stream', send log messages and result;
+       return False if the daemon cannot build the site because the extension has changed"""
+    try:
+        request = json.loads(stream.readline())
+        args = Namespace(**request['args'])
+    except (ValueError, KeyError, TypeError) as e: # not a request of 'bass --build'
+        logger.warning(f'Invalid request for build daemon: {e!r}')
+        reply(stream, dict(done=True, ok=False))
+        return True
+    if extension_digest() != digest:
+        reply(stream, dict(done=True, ok=False, restart=True))
+        return False
+    handler = ClientHandler(stream)
+    level = logger.level
+    logger.addHandler(handler)
+    if request.get('debug'):
+        logger.setLevel(logging.DEBUG)
+    try:
+        setting.args = args
+        build_site()
+        ok = True
+    except (Exception, SystemExit) as e:
+        logger.error(f'Build failed: {e!r}')
+        ok = False
+    finally:
+        logger.removeHandler(handler)
+        logger.setLevel(level)
+    reply(stream, dict(done=True, ok=ok))
+    return True
+
+def reply(stream, message):
+    """send message to the client, if it is still there"""
+    try:
+        stream.write(json.dumps(message) + '\n')
+    except OSError:
+        pass
+
+def build_remote():
+    """let the build daemon of the project build the site, print its log messages; return False
+       if there is no daemon (or it has stopped), exit if the build failed"""
+    read_config()
+    path = socket_path()
+    if not exists(path):
+        return False
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except OSError as e:
+        logger.debug(f'Cannot connect to build daemon: {e}')
+        client.close()
+        return False
+    args = {key: getattr(setting.args, key) for key in options}
+    result = {}
+    with client, client.makefile('rw') as stream:
+        stream.write(json.dumps(dict(args=args, debug=setting.args.debug)) + '\n')
+        stream.flush()
+        for line in stream:
+            message = json.loads(line)
+            if 'log' in message:
+                print(message['log'], file=sys.stderr)
+            if message.get('done'):
+                result = message
+                break
+    if not result or result.get('restart'):
+        logger.info('Build daemon has stopped, building site')
+        return False
+    if not result['ok']:
+        sys.exit(1)
+    return True
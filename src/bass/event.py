@@ -5,65 +5,159 @@ Objects and functions related to events and event handlers.
 """
 
 import re, sys
-from datetime import datetime, date
+from datetime import datetime, date, time
 from os.path import join, splitext, getctime, basename
-from . import setting
+from . import manifest, setting
+from .cache import open_cache
 from .markup import converter
-from .common import logger
+from .common import hash_file, hash_string, logger
+from .timing import timer
 
+# Event handlers are kept in lists, in the order in which they were added. Handlers for a single
+# event are stored in event_handler, with the event as key. Handlers for a pattern such as
+# 'render:pre:page:tag:*', i.e. an event that ends with '*', are stored in pattern_handler, with
+# the pattern as key; the pattern matches every event that starts with the part before the '*'.
+# Other characters are literal, so that events for file names with wildcard characters (e.g.
+# 'render:pre:page:name:a[1].mkd') are not patterns. For an event, the handlers for the event
+# itself are called first, then the handlers for the matching patterns. The patterns are
+# combined in one regular expression, so that an event without handlers costs one dictionary
+# lookup and at most one regex match.
 event_handler = {}
+pattern_handler = {}
+pattern_regex = None
+subscription = {} # memo for 'subscribed', with event prefix as key
 
-def combine(h1, h2):
-    def _h12(node):
-        h1(node)
-        h2(node)
-    return _h12
+def is_pattern(event):
+    """True if 'event' ends with a wildcard"""
+    return event.endswith('*')
+
+def update_index():
+    """recompile regular expression for patterns, clear memo for subscriptions"""
+    global pattern_regex
+    pattern_regex = re.compile('|'.join(re.escape(p[:-1]) for p in pattern_handler)) \
+                    if pattern_handler else None
+    subscription.clear()
 
 def add_handler(event, handler):
     """add handler for event"""
     if callable(handler):
-        if event in event_handler:
+        table = pattern_handler if is_pattern(event) else event_handler
+        if event in table:
             logger.debug(f'Event handler for {event} extended')
-            event_handler[event] = combine(event_handler[event], handler)
+            table[event].append(handler)
         else:
             logger.debug(f'New event handler for {event}')
-            event_handler[event] = handler
+            table[event] = [handler]
+        update_index()
     else:
         logger.debug(f'Event handler for {event} is not a callable')
 
 def copy_handler(from_event, to_event):
     """copy handler for event 'from_event' to event 'to_event'"""
-    if from_event in event_handler:
+    from_table = pattern_handler if is_pattern(from_event) else event_handler
+    if from_event in from_table:
         logger.debug(f'Event handler for {to_event} copied from {from_event}')
-        event_handler[to_event] = event_handler[from_event]
+        to_table = pattern_handler if is_pattern(to_event) else event_handler
+        to_table[to_event] = list(from_table[from_event])
+        update_index()
     else:
         logger.debug(f'No event handler for {from_event} - cannot copy')
 
 def remove_handler(event):
     """remove handler for event 'event'"""
-    if event in event_handler:
+    table = pattern_handler if is_pattern(event) else event_handler
+    if event in table:
         logger.debug(f'Event handler for {event} removed')
-        del event_handler[event]
+        del table[event]
+        update_index()
     else:
         logger.debug(f'No event handler for {event} - cannot remove')
 
+def subscribed(prefix):
+    """True if there are handlers for events starting with 'prefix';
+       use this to skip events for nodes with many details, e.g. tags"""
+    if prefix not in subscription:
+        subscription[prefix] = any(e.startswith(prefix) for e in event_handler) or \
+            any(prefix.startswith(p[:-1]) or p.startswith(prefix) for p in pattern_handler)
+    return subscription[prefix]
+
+def call(handler, node):
+    """call handler for node, measure time if profiling is enabled"""
+    if setting.profile:
+        name = getattr(handler, '__qualname__', None) or type(handler).__qualname__
+        with timer('handler', f'{getattr(handler, "__module__", "")}.{name}'):
+            handler(node)
+    else:
+        handler(node)
+
 def event(event, node):
-    """call handler for event 'event'"""
+    """call handler(s) for event 'event'; handlers added by these handlers are called for the
+       next event, not for this one"""
     if event in event_handler:
-        event_handler[event](node)
+        for handler in tuple(event_handler[event]):
+            call(handler, node)
+    if pattern_regex is not None and pattern_regex.match(event):
+        for pattern, handlers in tuple(pattern_handler.items()):
+            if event.startswith(pattern[:-1]):
+                for handler in tuple(handlers):
+                    call(handler, node)
 
 class Processor:
-    def __init__(self, converter=None):
-        """construct page processor for given markup converter"""
+    def __init__(self, converter=None, cache=True):
+        """construct page processor for given markup converter; if 'cache' is True,
+           results of the converter are kept in the conversion cache"""
         self.convert = converter
+        self.cache = cache and converter is not None
+        self.name = None
+        if converter is not None:
+            self.name = '{}.{}'.format(converter.__module__, converter.__qualname__)
+        self._signature = None
+
+    @property
+    def signature(self):
+        """name and options of converter, and for converters that are not built in, the digest
+           of the extension that defines them; determined when needed, since this may import
+           the package of the converter"""
+        if self._signature is None:
+            options = getattr(self.convert, 'options', '')
+            built_in = (self.name or '').startswith('bass.')
+            self._signature = '{}\n{}\n'.format(self.name or '',
+                                                 options() if callable(options) else options)
+            if not built_in: # the converter changes with the extension
+                self._signature += manifest.extension_digest() + '\n'
+        return self._signature
+
+    def cached_convert(self, text):
+        """convert text to HTML, use result from conversion cache if available"""
+        cache = open_cache('convert') if self.cache else None
+        if cache is None:
+            with timer('converter', self.name):
+                return self.convert(text)
+        key = hash_string(self.signature + text)
+        html = cache.get(key)
+        if html is None:
+            with timer('converter', self.name):
+                html = self.convert(text)
+            cache.put(key, html.encode('utf-8'))
+            return html
+        return html.decode('utf-8')
+
+    def convert_node(self, node):
+        """convert node.content and node.preview to HTML"""
+        if self.convert:
+            node.preview = self.cached_convert(node.preview) if node.preview else ''
+            node.content = self.cached_convert(node.content)
 
     def __call__(self, node):
         """convert node.content, node.preview and node.meta, which are set by the node constructor,
            to HTML; set elements of node.meta as attributes of node; set node.url"""
-        if self.convert:
-            # convert node.content and node.preview
-            node.preview = self.convert(node.preview) if node.preview else ''
-            node.content = self.convert(node.content)
+        if setting.lazy: # content is converted when it is loaded
+            node.processor = self
+            if node.loaded() and node.converted != self.name: # loaded by an earlier handler
+                self.convert_node(node)
+                node.converted = self.name
+        elif node.converted is None or node.converted != self.name:
+            self.convert_node(node)
         # process metadata
         full_path = join(setting.input, node.path)
         node.meta = complete_meta(node.meta, full_path)
@@ -139,14 +233,56 @@ if '.txi' in converter:
     textile_processor = Processor(converter['.txi'])
     add_handler('generate:post:page:extension:txi', textile_processor)
 
-html_processor = Processor(converter['.html'])
+# conversion of HTML and plain text is cheaper than a cache lookup
+html_processor = Processor(converter['.html'], cache=False)
 add_handler('generate:post:page:extension:html', html_processor)
 
-text_processor = Processor(converter['.txt'])
+text_processor = Processor(converter['.txt'], cache=False)
 add_handler('generate:post:page:extension:txt', text_processor)
 
 # auxiliary functions for extensions
 
+# Fragments of tables of contents are cached per build in 'fragments', and between builds in the
+# 'fragment' cache, with a digest of the template (and of the templates of which it may use
+# macros, see manifest.template_depends), the extension, and the attributes and content
+# of the node as key. The content of a page that is not loaded (lazy mode) is represented by its
+# source file and page processor, since that is what it would be converted from.
+fragments = {}
+plain_types = (str, int, float, date, time)
+
+def fragment_key(skin, node):
+    """key for fragment of node rendered with template 'skin', or None if it cannot be cached"""
+    if not hasattr(node, 'loaded'):
+        return None
+    if node.loaded():
+        content = hash_string(node.preview + '\n---\n' + node.content)
+    else:
+        content = hash_file(node.source) + (node.processor.signature if node.processor else '')
+    attributes = sorted((key, value) for key, value in vars(node).items()
+                        if isinstance(value, plain_types) or
+                        isinstance(value, (list, tuple)) and all(isinstance(v, plain_types) for v in value))
+    templates = (manifest.template_digest(skin), sorted(manifest.template_depends(skin).items()))
+    return hash_string(repr((skin, templates, manifest.digest.get('extension'),
+                             node.kind, node.id, node.path, node.url, node.tags, attributes, content)))
+
+def render_fragment(skin, node):
+    """render fragment of node with template 'skin', use cached fragment if possible"""
+    key = fragment_key(skin, node)
+    if key is None:
+        return setting.template[skin].render(this=node)
+    if key in fragments:
+        return fragments[key]
+    cache = open_cache('fragment')
+    value = cache.get(key) if cache else None
+    if value is None:
+        fragment = setting.template[skin].render(this=node)
+        if cache:
+            cache.put(key, fragment.encode('utf-8'))
+    else:
+        fragment = value.decode('utf-8')
+    fragments[key] = fragment
+    return fragment
+
 # partition and add_toc can be used in event handlers to produce index pages (with optional pagination).
 def partition(lst, size):
     """divide list in list of sub-lists of length <= size"""
@@ -169,12 +305,22 @@ def add_toc(page, nodelist, skin, sep='_', size=10):
         func = skin
     elif isinstance(skin, str):
         logger.debug('add_toc: skin is template')
-        func = setting.template[skin].render
+        func = lambda this: render_fragment(skin, this)
     else:
         logger.critical("Bad parameter 'skin' in function 'add_toc'")
         sys.exit(1)
+    # sub-pages are copies of the page: they have the same dependencies as the page has now
+    inherited = dict(manifest.depends.get(page.path, {}))
+    nodelist = list(nodelist)
     # create one HTML fragment per node, then partition the list of fragments in chunks of 'size'
-    parts = partition([func(this=node) for node in nodelist], size)
+    fragments = []
+    for node in nodelist:
+        loaded = node.loaded() if hasattr(node, 'loaded') else True
+        fragments.append(func(this=node))
+        if not loaded: # page was loaded for this fragment only
+            node.release()
+    parts = partition(fragments, size)
+    listed = partition(nodelist, size)
     # create 'prev' and 'next' links
     page.prev, page.next = None, None
     previous = page
@@ -193,14 +339,80 @@ def add_toc(page, nodelist, skin, sep='_', size=10):
             current.prev = previous
             previous = current
         previous.next = None # last subpage
+    # pages with a table of contents depend on the part of the table of contents they show,
+    # i.e. on the listed pages and the template, and on the pages they link to
+    node, n = page, 0
+    while node is not None:
+        manifest.depend(node, 'toc', hash_string(repr((node.toc, node.prev and node.prev.url,
+                                                       node.next and node.next.url))))
+        if isinstance(skin, str):
+            manifest.depend(node, 'template:'+skin, manifest.template_digest(skin))
+        for item in (listed[n] if n < len(listed) else []):
+            manifest.depend(node, 'page:'+item.path, item.url)
+        if node is not page:
+            for name, value in inherited.items():
+                manifest.depend(node, name, value)
+            manifest.depend(node, 'page:'+page.path, page.url)
+        node, n = node.next, n+1
 
-# resolve_idref is an event handler for resolving idref notation in href attributes.
+# Rewriters change the HTML of a page (preview and content) with a regular expression and a
+# replacement: a string (with references to groups, as in re.sub) or a function, which is called
+# with the page and the match object. A rewriter is an event handler: handling an event only
+# selects the rewriter for the page. At the end of the pre-render phase of the page, the selected
+# rewriters are applied, in the order in which they were added; pre-render handlers see the page
+# before it is rewritten. A rewriter of which the pattern does not occur in the page costs one
+# scan, and does not copy the page. Combining the patterns in one regular expression would be
+# slower: the re module only uses its fast search for patterns with a literal prefix, not for
+# alternatives.
+rewriters = [] # all rewriters; a rewriter is identified by its index
+selected = {}  # indexes of selected rewriters, with the path of the page as key
+
+class Rewriter:
+    def __init__(self, pattern, replacement):
+        """construct rewriter for regular expression 'pattern' (string or compiled)"""
+        self.pattern = re.compile(pattern)
+        self.replacement = replacement
+        self.index = len(rewriters)
+        rewriters.append(self)
+
+    def __call__(self, node):
+        """select rewriter for page"""
+        selected.setdefault(node.path, set()).add(self.index)
+
+    def rewrite(self, node, text):
+        """apply rewriter to text of page"""
+        if callable(self.replacement):
+            return self.pattern.sub(lambda mo: self.replacement(node, mo), text)
+        return self.pattern.sub(self.replacement, text)
+
+def add_rewriter(event, pattern, replacement):
+    """add rewriter for pattern and replacement, for pages that send the event"""
+    add_handler(event, Rewriter(pattern, replacement))
+
+def rewrite(node):
+    """apply rewriters selected for page to its preview and content"""
+    indexes = selected.pop(node.path, None)
+    if not indexes:
+        return
+    with timer('handler', 'bass.event.rewrite'):
+        preview, content = node.preview, node.content
+        for index in sorted(indexes):
+            preview = rewriters[index].rewrite(node, preview)
+            content = rewriters[index].rewrite(node, content)
+        node.preview, node.content = preview, content
+
+# resolve_idref is an event handler for resolving idref notation in href attributes. It is not
+# a rewriter: links are resolved when the event is handled, so that the handlers after it see them.
 idref_regex = re.compile(r"href=(['\"])idref:\s*(\w+?)\1")
 
 def resolve_idref(node):
     """replace href='idref:FOO' with href='BAR', where BAR is the URL of the page with id=FOO"""
     def idref_replace(mo):
         catch = node.root().pages(idref=mo.group(2), deep=True)
+        if catch:
+            manifest.depend(node, 'link:'+catch[0].path, catch[0].url)
+        else:
+            manifest.depend(node, 'idref:'+mo.group(2), '#')
         return "href={0}{1}{0}".format(mo.group(1), catch[0].url if catch else '#')
 
     node.preview = idref_regex.sub(idref_replace, node.preview)
@@ -5,15 +5,16 @@ Objects and functions related to the layout of the rendered pages.
 Chameleon is the primary template engine. Other template engines can be added.
 """
 
-from . import setting
-from .common import logger
-from os import listdir
-from os.path import join, splitext, isfile
-import sys
-
-# By default, there is one template factory: chameleon.PageTemplateFile. This is associated
-# with the file extensions '.xml' and '.pt'. Other template factories can be defined,
-# provided they implement the following interface:
+from . import output, setting
+from .cache import open_cache
+from .common import available, logger
+from os import getpid, listdir, makedirs, stat, unlink
+from os.path import dirname, join, splitext, isfile
+import re, sys
+
+# By default, there is one template factory: chameleon_template, which creates a
+# chameleon.PageTemplateFile. This is associated with the file extensions '.xml' and '.pt'.
+# Other template factories can be defined, provided they implement the following interface:
 #   - filename -> template: template = template_factory(filename)
 #   - node     -> string: template.render(this=node) returns HTML page for node 'this'
 #                 (condition: node.skin should be equal to filename without extension)
@@ -21,6 +22,18 @@ import sys
 
 template_factory = {}
 
+# Template files, with the template name as key. This is used by the build manifest.
+template_file = {}
+
+# Templates are kept between builds in the same process (development server), and only created
+# again if the template file has changed: template_cache[path] = (signature, template), where
+# signature = (factory, modification time, size, layout). A template can use macros of other
+# templates, which are loaded with it: 'layout' (modification times and sizes of all templates)
+# is part of the signature of templates that use macros. Chameleon templates are compiled to
+# Python modules, which are kept in the 'templates' cache if caching is enabled.
+template_cache = {}
+module_loaders = {}
+
 def add_template_type(extension, factory):
     """
     add template factory for given extension
@@ -43,31 +56,143 @@ def copy_template_type(from_extension, to_extension):
     else:
         logger.debug(f'No template type {from_extension}')
 
-try:
+# Chameleon is imported when the first template is read, not when Bass starts.
+def chameleon_template(path):
+    """template factory for Chameleon page templates"""
     from chameleon import PageTemplateFile
-    add_template_type('.xml', PageTemplateFile)
+    return PageTemplateFile(path)
+
+def is_chameleon(template):
+    """True if template is a Chameleon template"""
+    module = sys.modules.get('chameleon.template') # not imported: no Chameleon templates
+    return module is not None and isinstance(template, module.BaseTemplate)
+
+if available('chameleon'):
+    add_template_type('.xml', chameleon_template)
     copy_template_type('.xml', '.pt')
-except ImportError:
+else:
     logger.critical('Chameleon template engine not available')
     sys.exit(1)
 
+def module_loader():
+    """return loader for Chameleon that keeps compiled templates in the cache, or None"""
+    cache = open_cache('templates')
+    if cache is None:
+        return None
+    if cache.directory not in module_loaders:
+        from chameleon.loader import ModuleLoader
+        makedirs(cache.directory, exist_ok=True)
+        module_loaders[cache.directory] = ModuleLoader(cache.directory)
+    return module_loaders[cache.directory]
+
+# metal:use-macro or metal:extend-macro in a template
+macro_regex = re.compile(r'\b(use|extend)-macro\s*=')
+
+def uses_macros(path):
+    """True if the template file uses macros, which may be defined in other templates"""
+    with open(path, 'r', errors='replace') as f:
+        return macro_regex.search(f.read()) is not None
+
+def load_template(factory, path, layout=()):
+    """return template for file, created by factory, or the same template as in the previous
+       build if the file (and for templates that use macros, the layout) has not changed"""
+    info = stat(path)
+    signature = (factory, info.st_mtime_ns, info.st_size, layout if uses_macros(path) else ())
+    entry = template_cache.get(path)
+    if entry and entry[0] == signature:
+        return entry[1]
+    logger.debug(f'Loading template {path}')
+    template = factory(path)
+    if is_chameleon(template):
+        loader = module_loader()
+        if loader:
+            template.loader = loader
+        # compile now, not in every worker process of a parallel build
+        template.cook_check()
+    template_cache[path] = (signature, template)
+    return template
+
+# Chameleon templates write their output to a stream, which is a list of strings by default. For
+# pages, OutputStream is used instead, which passes the output in chunks to the write method of
+# the output file, so that a large page is never completely in memory. The file is written under
+# a temporary name and renamed when it is complete, so that the development server never serves a
+# partial page. If there is a thread pool for writing (see bass.output), the file is closed (which
+# flushes it) and renamed by the pool, while the next page is rendered.
+
+class OutputStream(list):
+    """output stream for Chameleon templates that passes output in chunks to 'write'"""
+    chunk_size = 1<<16 # characters
+
+    def __init__(self, write):
+        super().__init__()
+        self.write = write
+        self.size = 0
+        self.streaming = True
+
+    def append(self, text):
+        list.append(self, text)
+        self.size += len(text)
+        if self.size >= self.chunk_size and self.streaming:
+            self.write(''.join(self))
+            self.clear()
+            self.size = 0
+
+    def __len__(self):
+        # only used for tal:on-error, which removes the output of the failed element
+        # afterwards: from now on, keep all output in memory
+        self.streaming = False
+        return list.__len__(self)
+
+def render_stream(template, write, **kwargs):
+    """render template with given arguments, pass output in chunks to 'write'"""
+    if is_chameleon(template):
+        stream = OutputStream(write)
+        template.output_stream_factory = lambda: stream
+        try:
+            write(template.render(**kwargs)) # remaining output
+        finally:
+            del template.output_stream_factory
+    else:
+        write(template.render(**kwargs))
+
+def render_file(template, path, **kwargs):
+    """render template with given arguments, write output to file while it is rendered"""
+    output.make_directory(dirname(path)) # may still be pending in the thread pool
+    temp_path = f'{path}.{getpid()}.tmp'
+    f = open(temp_path, 'w', buffering=OutputStream.chunk_size)
+    try:
+        render_stream(template, f.write, **kwargs)
+    except BaseException:
+        f.close()
+        unlink(temp_path)
+        raise
+    output.submit(output.finish_file, f, temp_path, path)
+
 def read_templates():
     """Read templates from layout directory. This function should be called
     just before rendering the site tree and after the extensions have been imported."""
     template = {}
+    template_file.clear()
     template_types = list(template_factory.keys())
     logger.debug('Scanning for templates in {}'.format(setting.layout))
     logger.debug('Template types: {}'.format(' '.join(template_types)))
-    for filename in listdir(setting.layout):
+    # all files (not symbolic links) with a recognized extension are possible templates,
+    # other files are ignored
+    files = {}
+    for filename in sorted(listdir(setting.layout)):
+        file_path = join(setting.layout, filename)
+        if isfile(file_path) and splitext(filename)[1] in template_types:
+            files[filename] = stat(file_path)
+    layout = tuple((filename, info.st_mtime_ns, info.st_size) for filename, info in files.items())
+    for filename in files:
         (name, extension) = splitext(filename)
         file_path = join(setting.layout, filename)
-        # all files (not symbolic links) with a recognized extension are possible templates
-        if isfile(file_path) and extension in template_types: # other files are ignored
-            try:
-                template[name] = template_factory[extension](file_path)
-            except Exception as e:
-                logger.debug(f'Error in template for {name} in file {filename}')
-                logger.debug(str(e))
+        try:
+            template[name] = load_template(template_factory[extension], file_path, layout)
+            template_file[name] = file_path
+        except Exception as e:
+            logger.debug(f'Error in template for {name} in file {filename}')
+            logger.debug(str(e))
     if 'default' in template:
         setting.template = template
     else:
@@ -0,0 +1,233 @@
+"""
+bass.manifest
+-----
+Objects and functions related to the build manifest.
+
+The build manifest records for every file and directory in the output directory the inputs
+it was generated from: source file (modification time, size, content hash), template and
+extension. It is written after every build. In an incremental build, outputs of which the
+inputs did not change are not generated again, and outputs that are no longer part of the site
+tree are removed.
+
+The inputs of a page also include other pages: pages referred to by idref links, and pages
+listed in a table of contents. These dependencies are recorded by the event handlers that
+create them (see 'depend') during the pre-render phase of the page, i.e. before the manifest
+decides whether the page has to be generated again. Together, the entries of the manifest form
+a dependency graph, which can be queried with 'dependents'. Templates can read any node of the
+site tree (e.g. a menu with the titles of the pages in a folder), which is not recorded: as a
+safety net, all outputs are generated again if the site tree has changed (see 'tree_digest').
+"""
+
+import json
+from os import makedirs, replace, rmdir, scandir, stat, unlink, walk
+from os.path import basename, exists, isdir, isfile, join, relpath, splitext
+from . import setting
+from .common import hash_file, hash_string, logger
+from .layout import template_file, uses_macros
+from .output import compressed_variants
+
+manifest_version = 2
+
+previous = {}    # entries of the previous build, with output path as key
+current  = {}    # entries of the current build, with output path as key
+digest   = {}    # digests of extension, site tree and templates in the current build
+header   = {}    # digests of extension and site tree in the previous build
+depends  = {}    # dependencies recorded in the current build, with node path as key
+generated = set() # outputs that are generated again in the current build
+# In a rebuild after changes reported by the development server, outputs that do not depend on
+# the changed files (see 'dependents') are up to date if their recorded inputs are the same: their
+# source files are not checked again. None in other builds.
+affected = None
+
+def manifest_path():
+    """path of manifest file in cache directory"""
+    return join(setting.cache, 'manifest.json')
+
+def read_manifest():
+    """read manifest of previous build, return True if it can be used for an incremental build"""
+    previous.clear()
+    header.clear()
+    path = manifest_path()
+    if not isfile(path):
+        logger.debug(f'No build manifest {path}')
+        return False
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.debug(f'Build manifest {path} cannot be read: {e}')
+        return False
+    if data.get('version') != manifest_version or data.get('output') != setting.output:
+        logger.debug(f'Build manifest {path} does not match this project')
+        return False
+    header.update(data['digest'])
+    previous.update(data['entries'])
+    return True
+
+def write_manifest():
+    """write manifest of current build to cache directory"""
+    makedirs(setting.cache, exist_ok=True)
+    path = manifest_path()
+    data = dict(version=manifest_version, output=setting.output,
+                digest=dict(extension=digest['extension'], tree=digest['tree']),
+                entries=current)
+    logger.debug(f'Writing build manifest {path}')
+    with open(path+'.tmp', 'w') as f:
+        json.dump(data, f)
+    replace(path+'.tmp', path)
+
+def extension_digest():
+    """digest of all files in the extension package"""
+    if not setting.extension:
+        return ''
+    parts = []
+    for dirpath, dirnames, filenames in walk(join(setting.project, setting.extension)):
+        dirnames[:] = sorted(d for d in dirnames if d != '__pycache__')
+        parts.extend(f'{relpath(join(dirpath, f), setting.project)}:{hash_file(join(dirpath, f))}'
+                     for f in sorted(filenames) if f.endswith('.py'))
+    return hash_string('\n'.join(parts))
+
+def tree_digest(root):
+    """digest of the attributes of all pages that other pages can refer to"""
+    pages = sorted(root.pages(deep=True), key=lambda page: page.path)
+    return hash_string('\n'.join(repr((page.path, page.url, page.id, getattr(page, 'title', ''),
+                                       page.tags)) for page in pages))
+
+def template_digest(skin):
+    """digest of the template file for the given skin"""
+    key = 'template:'+skin
+    if key not in digest:
+        digest[key] = hash_file(template_file[skin]) if skin in template_file else None
+    return digest[key]
+
+# A template that uses macros (metal:use-macro, metal:extend-macro) can load them from any file in
+# the layout directory, so pages with such a template depend on all templates.
+def template_depends(skin):
+    """dependencies of pages with the given skin on other templates (as for 'depend')"""
+    key = 'macros:'+skin
+    if key not in digest:
+        digest[key] = {}
+        if skin in template_file and uses_macros(template_file[skin]):
+            digest[key] = {'template:'+name: template_digest(name)
+                           for name in sorted(template_file) if name != skin}
+    return digest[key]
+
+def start_manifest(root, changed=None):
+    """compute digests for the current build, before the site tree is rendered; 'changed' are
+       the input files that changed since the previous build, if they are known"""
+    global affected
+    current.clear()
+    digest.clear()
+    depends.clear()
+    generated.clear()
+    digest['extension'] = extension_digest()
+    digest['tree'] = tree_digest(root)
+    # a changed extension or site tree can affect every output
+    digest['stale'] = not setting.incremental or header != dict(extension=digest['extension'],
+                                                                 tree=digest['tree'])
+    if setting.incremental and digest['stale']:
+        logger.info('Extension or site tree changed, all outputs are generated again')
+    affected = dependents(changed) if changed and not digest['stale'] else None
+    if affected is not None:
+        logger.info(f'{len(affected)} outputs depend on the changed files')
+
+def depend(node, name, value):
+    """record that output of node depends on input 'name', which has the given value (a string,
+       e.g. a digest or URL); if the value differs from the previous build, the node is outdated"""
+    depends.setdefault(node.path, {})[name] = value
+
+def dependents(paths):
+    """return output paths (relative to output directory) of the previous build that depend on
+       the given input files: an upper bound of the outputs that change if the metadata of the
+       changed pages did not change (otherwise the site tree changes, see start_manifest)"""
+    sources = {entry['source'] for entry in previous.values()}
+    changed = set()
+    for path in paths:
+        if path.startswith(join(setting.project, setting.extension or '\0')):
+            return set(previous) # every output depends on the extension
+        if path.startswith(setting.layout):
+            changed.add('template:' + splitext(basename(path))[0])
+        elif relpath(path, setting.input) in sources and isfile(path):
+            changed.add('page:' + relpath(path, setting.input))
+        elif relpath(path, setting.input) in sources or exists(path):
+            return set(previous) # file added or removed: the site tree changes
+        # otherwise: temporary file (e.g. of an editor), created and removed again
+    # links ('link:' dependencies) only depend on the URL of a page, which does not change with
+    # its content; pages listed in a table of contents are shown with their preview
+    return {key for key, entry in previous.items()
+            if 'page:' + entry['source'] in changed or
+               'template:' + str(entry.get('skin')) in changed or
+               changed.intersection(entry.get('depends', {}))}
+
+def changed_outputs():
+    """return output paths (relative to output directory) that were generated again or removed
+       in the current build"""
+    return generated | (previous.keys() - current.keys())
+
+def add_folder(node, dirpath):
+    """add entry for output directory of folder node"""
+    current[relpath(dirpath, setting.output)] = dict(kind=node.kind, source=node.path)
+
+def unchanged(node, output_path):
+    """add entry for output file of page or asset node,
+       return True if this is an incremental build and the output file is up to date"""
+    key = relpath(output_path, setting.output)
+    # sub-pages of a table of contents have the source of the main page
+    source = getattr(node, 'source', None) or join(setting.input, node.path)
+    old = previous.get(key)
+    if affected is not None and key not in affected and old is not None:
+        mtime, size = old['mtime'], old['size'] # source has not changed
+    else:
+        try:
+            info = stat(source)
+            mtime, size = info.st_mtime, info.st_size
+        except OSError: # node created by an event handler
+            mtime, size = None, None
+    inputs = dict(depends.get(node.path, {}))
+    if node.kind == 'Page':
+        inputs.update(template_depends(node.skin))
+    entry = dict(kind=node.kind, source=node.path, mtime=mtime, size=size,
+                 hash=None, extension=digest['extension'],
+                 skin=node.skin if node.kind == 'Page' else None,
+                 template=template_digest(node.skin) if node.kind == 'Page' else None,
+                 depends=inputs)
+    current[key] = entry
+    for variant in compressed_variants(output_path):
+        current[relpath(variant, setting.output)] = dict(kind='Compressed', source=node.path)
+    if up_to_date(old, entry, source, output_path):
+        return True
+    generated.add(key)
+    return False
+
+def up_to_date(old, entry, source, output_path):
+    """return True if the output file with the given entries of the previous and current build
+       does not have to be generated again"""
+    if digest['stale'] or old is None or not isfile(output_path):
+        return False
+    if any(old.get(field) != entry[field] for field in ('kind', 'source', 'template', 'extension', 'depends')):
+        return False
+    if entry['mtime'] is None: # node created by an event handler without source file
+        return False
+    if old['mtime'] == entry['mtime'] and old['size'] == entry['size']:
+        entry['hash'] = old['hash']
+        return True
+    if old['size'] != entry['size']:
+        return False
+    # modification time changed, size did not: compare content
+    entry['hash'] = hash_file(source)
+    return entry['hash'] == old['hash']
+
+def remove_orphans():
+    """remove outputs of the previous build that are not part of the current build"""
+    orphans = [key for key in previous if key not in current]
+    # files first, then directories (deepest first)
+    orphans.sort(key=lambda key: (previous[key]['kind'] == 'Folder', -key.count('/')))
+    for key in orphans:
+        path = join(setting.output, key)
+        if previous[key]['kind'] == 'Folder':
+            if isdir(path) and not any(True for _ in scandir(path)):
+                logger.debug(f'Removing directory {path}')
+                rmdir(path)
+        elif isfile(path):
+            logger.debug(f'Removing file {path}')
+            unlink(path)
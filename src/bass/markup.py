@@ -2,65 +2,87 @@
 bass.markup
 -----
 Objects and functions related to markup of text pages.
+
+Converters are registered by file extension if the package they need is installed, but the
+package is only imported when the first page is converted, so that Bass starts quickly and only
+loads the packages that the site actually uses.
+
+A converter can have an attribute 'options', a function that returns a string describing the
+options of the converter and the version of the underlying package. This is part of the key of
+the conversion cache, so that a change of options invalidates the cached results.
 """
 
 import re
+from .common import available
 
 # available page converters
 converter = {}
 
+def version(module):
+    """version of imported module"""
+    return getattr(module, '__version__', '')
+
 # Pygments
-try:
-    import pygments
-    have_pygments = True
-except:
-    have_pygments = False
+have_pygments = available('pygments')
 
 # Markdown
-try:
-    import markdown2
+if available('markdown2'):
+    md2_extras = ['tables']
+    if have_pygments:
+        md2_extras.append('fenced-code-blocks')
     def convert_md2(text):
-        extensions = ['tables']
-        if have_pygments:
-            extensions.append('fenced-code-blocks')
-        return markdown2.markdown(text, extras=extensions)
+        import markdown2
+        return markdown2.markdown(text, extras=md2_extras)
+    def options_md2():
+        import markdown2
+        return f'markdown2 {version(markdown2)} {md2_extras}'
+    convert_md2.options = options_md2
     converter['.mkd'] = convert_md2
     have_markdown  = True
-except ImportError:
+else:
     have_markdown  = False
 
-if not have_markdown:
-    try:
+if not have_markdown and available('markdown'):
+    mkd_extras = ['markdown.extensions.tables']
+    if have_pygments:
+        mkd_extras.extend(['markdown.extensions.codehilite', 'markdown.extensions.fenced_code'])
+    def convert_mkd(text):
+        import markdown
+        return markdown.markdown(text, extensions=mkd_extras)
+    def options_mkd():
         import markdown
-        def convert_mkd(text):
-            extras = ['markdown.extensions.tables']
-            if have_pygments:
-                extras.extend(['markdown.extensions.codehilite', 'markdown.extensions.fenced_code'])
-            return markdown.markdown(text, extensions=extras)
-        converter['.mkd'] = convert_mkd
-        have_markdown = True
-    except ImportError:
-        have_markdown = False
+        return f'markdown {version(markdown)} {mkd_extras}'
+    convert_mkd.options = options_mkd
+    converter['.mkd'] = convert_mkd
+    have_markdown = True
 
 # RestructuredText
-try:
-    import docutils.core
-    from docutils.writers.html4css1 import Writer
+if available('docutils'):
     def convert_rst(text):
+        import docutils.core
+        from docutils.writers.html4css1 import Writer
         return docutils.core.publish_parts(text, writer=Writer())['body']
+    def options_rst():
+        import docutils
+        return f'docutils {version(docutils)} html4css1'
+    convert_rst.options = options_rst
     converter['.rst'] = convert_rst
     have_rest = True
-except ImportError:
+else:
     have_rest = False
 
 # Textile
-try:
-    import textile
+if available('textile'):
     def convert_txi(text):
+        import textile
         return textile.textile(text)
+    def options_txi():
+        import textile
+        return f'textile {version(textile)}'
+    convert_txi.options = options_txi
     converter['.txi'] = convert_txi
     have_textile = True
-except ImportError:
+else:
     have_textile = False
 
 # HTML
@@ -0,0 +1,181 @@
+"""
+bass.output
+-----
+Objects and functions for writing files and directories to the output directory.
+
+Rendering pages is mostly CPU-bound, writing them is I/O-bound. To overlap the two, directories
+are created, and pages are completed (the output file is closed, which flushes it, and renamed),
+by a pool of threads (configuration option 'write_jobs'). The number of pending writes is
+limited, so that rendering cannot run far ahead of writing, and the number of open files stays
+bounded. If write_jobs is 1, everything is done immediately by the rendering thread.
+
+If the configuration option 'compress' is true, compressed variants are written next to every
+output file of a compressible type: FILE.gz, and FILE.br if the package brotli is installed.
+Web servers such as nginx (gzip_static, brotli_static) can serve these directly. A compressed
+variant gets the modification time of the output file, so that it can be skipped if it is
+up to date.
+
+The development server keeps output files in memory (see start_store), so that most requests do
+not read the file system. A file is put in the store (read back, usually from the page cache of
+the operating system) after it has been written by the render step, and by the server for files
+that were written elsewhere (e.g. by worker processes).
+"""
+
+import gzip
+from hashlib import sha1
+from concurrent.futures import ThreadPoolExecutor
+from os import getpid, makedirs, replace, stat, unlink, utime
+from os.path import abspath, exists, splitext
+from threading import BoundedSemaphore
+from . import setting
+from .common import available, logger
+
+pool = None        # thread pool for writing, see start_output
+pending = None     # semaphore limiting the number of pending writes
+errors = []        # exceptions raised by writes in the thread pool
+directories = set() # directories created during this build
+
+def start_output(threads, depth=4):
+    """start pool of 'threads' threads, with at most depth*threads pending writes
+       (no pool if threads < 2)"""
+    global pool, pending
+    directories.clear()
+    errors.clear()
+    if threads > 1:
+        pool = ThreadPoolExecutor(threads, thread_name_prefix='bass-output')
+        pending = BoundedSemaphore(depth * threads)
+
+def finish_output():
+    """wait until all pending writes are done, stop thread pool"""
+    global pool, pending
+    if pool is None:
+        return
+    pool.shutdown()
+    pool, pending = None, None
+    if errors:
+        raise errors[0]
+
+def done(future):
+    """callback for finished write"""
+    pending.release()
+    if future.exception() is not None:
+        errors.append(future.exception())
+
+def submit(function, *args):
+    """call function with given arguments in the thread pool, or immediately if there is none"""
+    if pool is None:
+        function(*args)
+        return
+    if errors: # do not continue the build after a failed write
+        raise errors[0]
+    pending.acquire()
+    pool.submit(function, *args).add_done_callback(done)
+
+# Memory store of output files: store[absolute path] = (data, etag, mtime_ns, size). The
+# modification time and size identify the version of the file: an entry is only used if they
+# match the file, so that files changed by worker processes or rebuilds are never served stale.
+# Files larger than store_limit are not kept (they are served from the file system).
+store = None
+store_limit = 1<<20 # bytes
+
+def start_store():
+    """keep output files in memory from now on"""
+    global store
+    if store is None:
+        store = {}
+
+def keep_file(path):
+    """put output file in memory store (if there is one)"""
+    if store is None:
+        return
+    path = abspath(path)
+    info = stat(path)
+    if info.st_size > store_limit:
+        store.pop(path, None)
+        return
+    with open(path, 'rb') as f:
+        data = f.read()
+    etag = sha1(data).hexdigest()
+    store[path] = (data, etag, info.st_mtime_ns, info.st_size)
+
+def stored_file(path):
+    """return (data, etag) of output file from memory store, reading it if it is not stored or
+       has changed; None if the file does not exist or is not kept in memory"""
+    if store is None:
+        return None
+    path = abspath(path)
+    try:
+        info = stat(path)
+        entry = store.get(path)
+        if entry is None or entry[2:] != (info.st_mtime_ns, info.st_size):
+            keep_file(path)
+            entry = store.get(path)
+    except OSError: # file does not exist (anymore)
+        store.pop(path, None)
+        return None
+    return entry[:2] if entry else None
+
+def make_directory(path):
+    """create directory (and parent directories) if it has not been created in this build"""
+    if path not in directories:
+        makedirs(path, exist_ok=True)
+        directories.add(path)
+
+def finish_file(f, temp_path, path):
+    """close file 'f', which was written under the temporary name, and rename it to 'path'"""
+    try:
+        f.close()
+        replace(temp_path, path)
+    except BaseException:
+        logger.debug(f'Cannot write file {path}')
+        if exists(temp_path):
+            unlink(temp_path)
+        raise
+    keep_file(path)
+    compress_file(path)
+
+# types of output files that are worth compressing
+compressible = {'.css', '.html', '.js', '.json', '.map', '.svg', '.txt', '.xml'}
+
+def gzip_data(data):
+    """compress with gzip (without time stamp, so that the result only depends on the data)"""
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+def brotli_data(data):
+    """compress with brotli"""
+    import brotli
+    return brotli.compress(data)
+
+# compression methods: (content encoding, file suffix, function), in order of preference
+encodings = [('gzip', '.gz', gzip_data)]
+if available('brotli'):
+    encodings.insert(0, ('br', '.br', brotli_data))
+
+def compressed_variants(path):
+    """paths of the compressed variants of an output file (none if compression is disabled)"""
+    if not setting.compress or splitext(path)[1] not in compressible:
+        return []
+    return [path + suffix for _, suffix, _ in encodings]
+
+def compress_file(path):
+    """write compressed variants of output file, unless they are up to date"""
+    if not compressed_variants(path):
+        return
+    info = stat(path)
+    data = None
+    for _, suffix, compress in encodings:
+        target = path + suffix
+        try:
+            if stat(target).st_mtime_ns == info.st_mtime_ns:
+                continue
+        except OSError: # no compressed variant yet
+            pass
+        if data is None:
+            with open(path, 'rb') as f:
+                data = f.read()
+        logger.debug(f'Writing compressed file {target}')
+        temp_path = f'{target}.{getpid()}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(compress(data))
+        utime(temp_path, ns=(info.st_atime_ns, info.st_mtime_ns))
+        replace(temp_path, target)
@@ -2,75 +2,208 @@
 bass.server
 -----
 Simple web server for development and test purposes.
+
+If WebOb is installed, the server rebuilds the site when files in the input or layout directory
+change, and it uses Waitress if that is installed too. Otherwise the basic web server from the
+standard library is used. These packages are imported when the server is started.
+
+Rebuilds run in a background thread, so that requests are never blocked by a build. A script is
+added to every page, which listens to an event stream (Server-Sent Events) of the server. After a
+rebuild, when all outputs are in place, the server sends the URLs of the changed outputs, and the
+script reloads the page if the page itself or one of the files it uses has changed. The URLs of
+the script and the event stream start with a dot, so they cannot be the URL of an output file.
+
+The WSGI-based server serves output files from a memory store that is filled after the render
+step has written them (see bass.output), with strong ETags, so that browsers can revalidate
+pages with conditional requests (304 Not Modified), and it supports range requests. If
+compressed variants of the output files are written (configuration option 'compress'), the
+server sends the variant that the client accepts (header Accept-Encoding) instead of the file
+itself, like a production web server would. Requests are handled in several threads.
 """
 
-from os import chdir, walk
-from os.path import join, getmtime
+import json, mimetypes
+from functools import partial
+from queue import Empty, Queue
+from threading import Event, Thread
+from os import stat
+from os.path import abspath, isfile, join, sep
 from datetime import datetime
 from .site import rebuild_site
 from . import setting
-from .common import logger
-
-try:
-    from webob import Request, Response
-    from webob.static import DirectoryApp
-
-    class Monitor:
-        """class for generating WSGI middleware handler"""
-        def __init__(self, app, checklist, callback):
-            self.wrapped = app
-            self.timestamp = datetime.now()
-            self.checklist = checklist
-            self.callback = callback
-
-        def changed(self):
-            """return True if any file in one of the directories in self.checklist has changed
-               since self.timestamp, otherwise False"""
-            for entry in self.checklist:
-                for (dirpath, _, filenames) in walk(entry):
-                    for f in filenames:
-                        path = join(dirpath, f)
-                        if datetime.fromtimestamp(getmtime(path)) > self.timestamp:
-                            logger.debug(f'File {path} has changed')
-                            return True
-            return False
-
-        def __call__(self, environ, start_response):
-            """this __call__ method turns an instance into a WSGI middleware handler"""
-            request = Request(environ)
-            # check for modifications every time a page (not an asset) is requested
-            if request.path.endswith('.html') and self.changed():
-                logger.debug('Rebuilding site')
-                self.timestamp = datetime.now()
-                self.callback()
-            response = request.get_response(self.wrapped)
-            dt = datetime.strftime(datetime.now(), "%d/%b/%Y %H:%M:%S")
-            logger.info('{} - - [{}] "{} {}" {} {}'.\
-                        format(request.server_name, dt, request.method, request.path_info,
-                               response.status, response.content_length))
-            return response(environ, start_response)
-
-    try:
-        from waitress import serve
-    except ImportError:
-        from wsgiref.simple_server import make_server
-        def serve(app, host, port):
-            """serve: WSGI server with same interface as waitress.serve"""
-            server = make_server(host, port, app)
-            server.serve_forever()
-
-    def http_server(host, port):
-        """http_server: WSGI-based web server with same interface as in standard library"""
+from .common import available, logger
+from .output import compressed_variants, encodings, start_store, stored_file
+
+threads = 16 # request threads of Waitress; every open event stream occupies one
+
+events_url = '/.bass/events'
+script_url = '/.bass/reload.js'
+reload_script = b'''(function () {
+  function changed(urls, url) { return urls.indexOf(new URL(url, location.href).pathname) >= 0; }
+  new EventSource('%s').onmessage = function (message) {
+    var urls = JSON.parse(message.data);
+    var used = document.querySelectorAll('link[href], script[src], img[src]');
+    if (changed(urls, location.href) ||
+        Array.prototype.some.call(used, function (e) { return changed(urls, e.href || e.src); }))
+      location.reload();
+  };
+})();
+''' % events_url.encode()
+
+class Monitor:
+    """class for generating WSGI middleware handler"""
+    def __init__(self, app, checklist, callback):
+        from .watch import watcher
+        self.wrapped = app
+        self.watcher = watcher(checklist)
+        self.callback = callback
+        self.idle = Event() # cleared while the site is rebuilt
+        self.idle.set()
+        self.clients = set() # message queues of the open event streams
+        Thread(target=self.build, name='bass-builder', daemon=True).start()
+
+    def build(self):
+        """build worker: rebuild site after changes, notify clients of the changed outputs"""
+        while True:
+            changed = self.watcher.changes()
+            if not changed:
+                continue
+            self.idle.clear()
+            try:
+                outputs = self.callback(changed)
+            except (Exception, SystemExit) as e: # keep serving the previous build
+                logger.error(f'Rebuilding site failed: {e}')
+                continue
+            finally:
+                self.idle.set()
+            if outputs:
+                self.notify(outputs)
+
+    def notify(self, outputs):
+        """send URLs of changed outputs to all open event streams"""
+        urls = sorted('/' + path.replace(sep, '/') for path in outputs)
+        logger.debug(f'Notifying {len(self.clients)} clients of {len(urls)} changed outputs')
+        message = f'data: {json.dumps(urls)}\n\n'.encode()
+        for queue in list(self.clients):
+            queue.put(message)
+
+    def events(self):
+        """response with event stream (Server-Sent Events) for the reload script"""
+        from webob import Response
+        queue = Queue()
+        self.clients.add(queue)
+        def stream():
+            try:
+                yield b'retry: 1000\n\n'
+                while True:
+                    try:
+                        yield queue.get(timeout=15)
+                    except Empty: # comment, to detect closed connections
+                        yield b': keep-alive\n\n'
+            finally:
+                self.clients.discard(queue)
+        return Response(app_iter=stream(), content_type='text/event-stream',
+                        cache_control='no-cache')
+
+    def __call__(self, environ, start_response):
+        """this __call__ method turns an instance into a WSGI middleware handler"""
+        from webob import Request, Response
+        request = Request(environ)
+        if request.path_info == events_url:
+            response = self.events()
+        elif request.path_info == script_url:
+            response = Response(body=reload_script, content_type='text/javascript',
+                                cache_control='no-cache')
+        else:
+            path = output_file(request)
+            if path is None and not self.idle.is_set():
+                # the file may be removed and written again by the running build
+                self.idle.wait()
+                path = output_file(request)
+            if path is None or request.method not in ('GET', 'HEAD'):
+                response = request.get_response(self.wrapped)
+            else:
+                response = file_response(request, path, script=script_url)
+        dt = datetime.strftime(datetime.now(), "%d/%b/%Y %H:%M:%S")
+        logger.info('{} - - [{}] "{} {}" {} {}'.\
+                    format(request.server_name, dt, request.method, request.path_info,
+                           response.status, response.content_length))
+        return response(environ, start_response)
+
+def output_file(request):
+    """path of the output file for request, None if there is no such file"""
+    root = abspath(setting.output)
+    path = abspath(join(root, request.path_info.lstrip('/'))) # resolves '..'
+    return path if path.startswith(root + sep) and isfile(path) else None
+
+def compressed_variant(request, path):
+    """(encoding, path) of an up-to-date compressed variant of output file that the client
+       accepts; (None, path) if there is none"""
+    if 'Accept-Encoding' not in request.headers or not compressed_variants(path):
+        return None, path
+    suffix = {encoding: suffix for encoding, suffix, _ in encodings}
+    for encoding, _ in request.accept_encoding.acceptable_offers(list(suffix)):
+        variant = path + suffix[encoding]
+        try:
+            if stat(variant).st_mtime_ns == stat(path).st_mtime_ns:
+                return encoding, variant
+        except OSError: # no compressed variant
+            pass
+    return None, path
+
+def add_script(data, url):
+    """add script element with given URL to HTML page, before the end of the body"""
+    tag = f'<script src="{url}"></script>'.encode()
+    index = data.rfind(b'</body>')
+    return data + tag if index < 0 else data[:index] + tag + data[index:]
+
+def file_response(request, path, script=None):
+    """response with output file (or compressed variant), from memory store if possible;
+       conditional and range requests are handled by WebOb; if 'script' is given, a script
+       element with this URL is added to pages (which are then not compressed)"""
+    from webob import Response
+    from webob.static import FileApp
+    page = script is not None and path.endswith('.html')
+    encoding, variant = (None, path) if page else compressed_variant(request, path)
+    headers = dict(content_type=mimetypes.guess_type(path)[0], content_encoding=encoding)
+    if compressed_variants(path):
+        headers['vary'] = ('Accept-Encoding',)
+    entry = stored_file(variant)
+    if entry is None: # large file: served from file system
+        info = stat(variant)
+        app = FileApp(variant, etag=f'{info.st_mtime_ns:x}-{info.st_size:x}', **headers)
+    else:
+        data, etag = entry
+        if page:
+            data = add_script(data, script)
+        app = Response(body=data, etag=etag, accept_ranges='bytes', conditional_response=True,
+                       **headers)
+    return request.get_response(app)
+
+def serve(app, host, port):
+    """serve: WSGI server, Waitress if available"""
+    if available('waitress'):
+        from waitress import serve as waitress_serve
+        waitress_serve(app, host=host, port=port, threads=threads)
+    else:
+        from socketserver import ThreadingMixIn
+        from wsgiref.simple_server import WSGIServer, make_server
+        class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+            daemon_threads = True
+        server = make_server(host, port, app, server_class=ThreadingWSGIServer)
+        server.serve_forever()
+
+def http_server(host, port):
+    """http_server: WSGI-based web server if WebOb is available, otherwise basic web server"""
+    if available('webob'):
+        from webob.static import DirectoryApp
+        start_store()
         static = DirectoryApp(setting.output, index_page=None)
         wrapped = Monitor(static, checklist=[setting.input, setting.layout], callback=rebuild_site)
         logger.info(f'Starting HTTP server (+watcher) on port {port}')
         serve(wrapped, host=host, port=port)
-
-except ImportError:
-    from http.server import HTTPServer, SimpleHTTPRequestHandler
-    def http_server(host, port):
-        """http_server: basic web server based on standard library"""
-        chdir(setting.output)
-        httpd = HTTPServer((host, port), SimpleHTTPRequestHandler)
+    else:
+        from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+        handler = partial(SimpleHTTPRequestHandler, directory=setting.output)
+        httpd = ThreadingHTTPServer((host, port), handler)
         logger.info(f'Starting HTTP server on port {port}')
         httpd.serve_forever()
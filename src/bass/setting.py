@@ -4,15 +4,27 @@ bass.setting
 Global settings, shared by all modules.
 """
 
+args         = None
+asset_copy   = None
+cache        = None
+cache_size   = None
+compress     = None
 extension    = None
 follow_links = None
 host         = None
 ignore       = None
+incremental  = None
 input        = None
+jobs         = None
 layout       = None
+lazy         = None
+meta_cache   = None
 output       = None
 port         = None
+profile      = None
 project      = None
 root_url     = None
 template     = None
+transform_jobs = None
 version      = '1.0.0'
+write_jobs   = None
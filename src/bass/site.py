@@ -4,18 +4,24 @@ bass.site
 Objects and functions related to site structure and site generation.
 """
 
-import shutil, sys, yaml
-from . import setting
+import pickle, re, shutil, sys, yaml
+from time import perf_counter
+from . import setting, timing
+from .timing import timer
 from .common import write_file
+from .cache import evict_caches
 from .config import config_default, read_config
-from .event import event_handler
+from .event import event_handler, fragments, selected
 from .layout import read_templates
+from .output import finish_output, start_output
+from .manifest import changed_outputs, read_manifest, remove_orphans, start_manifest, write_manifest
 from .common import logger
-from .tree import Folder, Page, Asset
-from fnmatch import fnmatch
+from .tree import Folder, Page, Asset, finish_transformers, prepare_page, render_parallel, start_transformers
+from fnmatch import translate
 from importlib import import_module
-from os import scandir, mkdir, unlink, walk
-from os.path import isdir, isfile, islink, join, relpath, splitext, split
+from multiprocessing import get_context
+from os import scandir, mkdir, sep, unlink
+from os.path import isdir, isfile, join, relpath, splitext
 
 def create_project():
     """create new project directory, with default configuration"""
@@ -31,24 +37,75 @@ def create_project():
 
 def build_site():
     """build site in project directory"""
+    start = perf_counter()
     read_config()
+    timing.record.clear()
+    if setting.profile:
+        timing.add('phase', 'read_config', perf_counter() - start)
     verify_project()
-    read_extension()
+    with timer('phase', 'read_extension'):
+        read_extension()
     logger.info('Building site tree')
-    root = generate_tree()
-    prepare_output()
-    read_templates()
-    logger.info('Rendering site tree')
-    root.render()
+    with timer('phase', 'generate_tree'):
+        root = generate_tree()
+    render_site(root)
+    if setting.profile:
+        timing.report()
 
-def rebuild_site():
-    """rebuild site in project directory"""
+def rebuild_site(changed=None):
+    """rebuild site in project directory after the files in 'changed' have changed;
+       only outputs that depend on changed files are checked and written, and pages kept in
+       memory (see keep_pages) are not read again; return the paths of the outputs that were
+       written or removed"""
+    if changed:
+        ignored = ignore_matcher(setting.ignore)
+        for path in sorted(changed):
+            logger.debug(f'File {path} has changed')
+        changed = {path for path in changed if not ignored_path(path, ignored)}
+        if not changed:
+            logger.debug('Only ignored files have changed')
+            return set()
     logger.info('Building modified site tree')
-    root = generate_tree()
-    prepare_output()
-    read_templates()
-    logger.info('Rendering modified site tree')
-    root.render()
+    setting.incremental = True
+    timing.record.clear()
+    with timer('phase', 'generate_tree'):
+        root = generate_tree()
+    render_site(root, changed)
+    if setting.profile:
+        timing.report()
+    return changed_outputs()
+
+def render_site(root, changed=None):
+    """render site tree to output directory; in an incremental build, only outputs
+       with changed inputs are generated, and outputs without a source are removed"""
+    if setting.incremental and read_manifest():
+        logger.info('Incremental build')
+    else:
+        with timer('phase', 'prepare_output'):
+            prepare_output()
+    with timer('phase', 'read_templates'):
+        read_templates()
+    start_manifest(root, changed)
+    fragments.clear()
+    selected.clear()
+    logger.info('Rendering site tree')
+    with timer('phase', 'render'):
+        if setting.jobs > 1:
+            start_output(1) # worker processes cannot use threads of the main process
+            render_parallel(root, setting.jobs)
+        else:
+            start_output(setting.write_jobs)
+            start_transformers(setting.transform_jobs)
+            try:
+                root.render()
+            finally:
+                finish_transformers()
+                finish_output()
+    with timer('phase', 'finish'):
+        if setting.incremental:
+            remove_orphans()
+        write_manifest()
+        evict_caches()
 
 def verify_project():
     """verify existence of directories specified in configuration"""
@@ -60,8 +117,9 @@ def read_extension():
     """read extension(s) from package specified in configuration file"""
     if setting.extension and isdir(join(setting.project, setting.extension)):
         try:
-            logger.debug(f'Adding project directory {setting.project} to Python path')
-            sys.path.insert(0, setting.project)
+            if setting.project not in sys.path: # the build daemon builds more than once
+                logger.debug(f'Adding project directory {setting.project} to Python path')
+                sys.path.insert(0, setting.project)
             logger.debug(f'Importing package {setting.extension}')
             module = import_module(setting.extension)
         except ImportError:
@@ -77,41 +135,122 @@ def prepare_output():
         else:
             shutil.rmtree(path)
 
-def ignore_entry(name_rel, dirname):
-    """True if 'name_rel' matches one of the ignore patterns or
-    if 'name_rel' refers to a symbolic link"""
-    return any([fnmatch(name_rel, pattern) for pattern in setting.ignore]) or \
-           (not setting.follow_links and islink(join(dirname, name_rel)))
+def ignore_matcher(patterns):
+    """return function that returns True if a name or relative path matches one of the
+       ignore patterns; the patterns are combined in one regular expression"""
+    regex = re.compile('|'.join(translate(pattern) for pattern in patterns)) if patterns else None
+    return (lambda name: regex.match(name) is not None) if regex else (lambda name: False)
+
+def ignored_path(path, ignored):
+    """True if the file is in the input directory, and the file or one of its directories is
+       ignored when the site tree is generated (see ignore_matcher)"""
+    relative = relpath(path, setting.input)
+    if relative.startswith('..'): # not in the input directory
+        return False
+    parts = relative.split(sep)
+    return any(ignored(parts[n]) or ignored(join(*parts[:n+1])) for n in range(len(parts)))
 
 def generate_tree():
     """generate site tree from files and directories in input directory"""
     logger.info('Ignore files/directories: {}'.format(' '.join(setting.ignore)))
     logger.info('Follow symbolic links: {}'.format(('no','yes')[setting.follow_links]))
     prefix = 'generate:post:page:extension:'
-    pagetypes = [key.replace(prefix, '.') for key in event_handler.keys() if key.startswith(prefix)]
-    logger.info('Page types: {}'.format(' '.join(pagetypes)))
-    folder_queue = {}
-    for dirpath, dirnames, filenames in walk(setting.input, topdown=False, followlinks=setting.follow_links):
-        dirpath_rel = relpath(dirpath, setting.input)
-        folder_name = split(dirpath_rel)[1]
-        if dirpath_rel == '.':
-            dirpath_rel, folder_name = '', ''
-        if ignore_entry(dirpath_rel, setting.input):
-            logger.debug(f'Ignore directory {dirpath_rel}')
-            continue
-        folder = Folder(folder_name, dirpath_rel, None)
-        for name in set(dirnames) & set(folder_queue.keys()):
-            folder.add(folder_queue[name])
-        for name in filenames: # pages and assets; become children of this folder
-            filename_rel = name if dirpath_rel == '.' else join(dirpath_rel, name)
-            if ignore_entry(filename_rel, setting.input):
-                logger.debug(f'Ignore file {filename_rel}')
-                continue
-            extension = splitext(name)[1]
-            this = (Page if extension in pagetypes else Asset)(name, filename_rel, None)
-            folder.add(this)
-            this.ready()
-        folder.ready()
-        folder_queue[folder_name] = folder
+    pagetypes = {key.replace(prefix, '.') for key in event_handler.keys() if key.startswith(prefix)}
+    logger.info('Page types: {}'.format(' '.join(sorted(pagetypes))))
+    ignored = ignore_matcher(setting.ignore)
     # by definition: folder with name = '' is the root of the site tree
-    return folder_queue['']
+    used.clear()
+    if setting.jobs > 1:
+        logger.info(f'Reading pages with {setting.jobs} processes')
+        with get_context('fork').Pool(setting.jobs, initializer=timing.record.clear) as pool:
+            root = generate_folder(scan_folder('', '', setting.input, pagetypes, ignored, pool))
+    else:
+        root = generate_folder(scan_folder('', '', setting.input, pagetypes, ignored, None))
+    if prepared_pages is not None: # forget removed pages
+        for path in prepared_pages.keys() - used:
+            del prepared_pages[path]
+    return root
+
+# The build daemon (see bass.daemon) keeps the pages that were read and converted in previous
+# builds in memory: prepared_pages[path] = (stamp, pickled result of prepare_page), where the
+# stamp consists of the modification time and size of the file, and the lazy setting. A pickled
+# copy is kept, so that changes of the page by event handlers do not affect the next build.
+prepared_pages = None
+used = set() # paths of the pages in this build
+
+def keep_pages():
+    """keep pages in memory from now on, for the next builds in this process"""
+    global prepared_pages
+    if prepared_pages is None:
+        prepared_pages = {}
+
+def kept_page(path, stamp):
+    """return prepared page from memory if it is up to date, otherwise None"""
+    used.add(path)
+    kept = prepared_pages.get(path)
+    return pickle.loads(kept[1]) if kept and kept[0] == stamp else None
+
+def keep_page(path, stamp, prepared):
+    """keep prepared page in memory"""
+    prepared_pages[path] = (stamp, pickle.dumps(prepared))
+
+# The site tree is generated in two passes. The first pass scans the input directory, and returns
+# a plan: a tuple (name, path, sub-folder plans, files) for every folder. If a process pool is
+# given, every page is submitted to the pool as soon as it is found, so that reading and
+# converting pages overlaps with scanning. The second pass creates the nodes and sends the
+# generate events, in the same order as without a pool: sub-folders first, then the pages and
+# assets of the folder, as in a bottom-up walk. Pages kept in memory (build daemon) are taken
+# from there if they have not changed.
+
+def scan_folder(name, path, dirpath, pagetypes, ignored, pool):
+    """return plan for folder of directory 'dirpath' (relative path 'path')"""
+    folders, files = [], []
+    # a DirEntry knows its type and whether it is a symbolic link without an extra system call
+    with scandir(dirpath) as entries:
+        for entry in entries:
+            entry_path = join(path, entry.name) if path else entry.name
+            if ignored(entry.name) or ignored(entry_path) or \
+               (not setting.follow_links and entry.is_symlink()):
+                logger.debug(f'Ignore {entry_path}')
+            elif entry.is_dir():
+                folders.append(scan_folder(entry.name, entry_path, entry.path, pagetypes, ignored, pool))
+            else:
+                suffix = splitext(entry.name)[1]
+                is_page = suffix in pagetypes
+                stamp, pending = None, None
+                if is_page and prepared_pages is not None:
+                    info = entry.stat()
+                    stamp = (info.st_mtime_ns, info.st_size, setting.lazy)
+                    pending = kept_page(entry.path, stamp)
+                if is_page and pool and pending is None:
+                    pending = pool.apply_async(prepare_page, (entry.path, suffix[1:]))
+                files.append((entry.name, entry_path, is_page, stamp, pending))
+    return name, path, folders, files
+
+def generate_folder(plan):
+    """create folder and its descendants according to plan, send generate events"""
+    name, path, folders, files = plan
+    folder = Folder(name, path, None)
+    for sub_plan in folders:
+        folder.add(generate_folder(sub_plan))
+    for file_name, file_path, is_page, stamp, pending in files: # pages and assets
+        if is_page:
+            prepared, measurements = None, None
+            if isinstance(pending, tuple): # kept in memory
+                prepared = pending
+            elif pending is not None: # result of worker process
+                prepared, measurements = pending.get()
+            elif stamp is not None: # to be kept in memory
+                prepared, measurements = prepare_page(join(setting.input, file_path),
+                                                      splitext(file_name)[1][1:])
+            if measurements:
+                timing.merge(measurements)
+            if stamp is not None and not isinstance(pending, tuple):
+                keep_page(join(setting.input, file_path), stamp, prepared)
+            this = Page(file_name, file_path, None, prepared)
+        else:
+            this = Asset(file_name, file_path, None)
+        folder.add(this)
+        this.ready()
+    folder.ready()
+    return folder
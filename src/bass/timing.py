@@ -0,0 +1,70 @@
+"""
+bass.timing
+-----
+Objects and functions for measuring where build time goes.
+
+If profiling is enabled (option --profile), the wall time and number of calls are recorded per
+category and name. The categories are: phase (read_config, generate_tree, prepare_output,
+read_templates, render), converter, template, page, handler and transformer. At the end of the
+build a report in JSON form is written, and a summary is logged.
+"""
+
+import json
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+from . import setting
+from .common import logger
+
+# record[category][name] = [count, seconds]
+record = {}
+lock = Lock() # asset transformers run in several threads
+
+def add(category, name, seconds, count=1):
+    """add measurement to record"""
+    with lock:
+        entry = record.setdefault(category, {}).setdefault(name, [0, 0.0])
+        entry[0] += count
+        entry[1] += seconds
+
+@contextmanager
+def timer(category, name):
+    """measure wall time of the 'with' block, if profiling is enabled"""
+    if not setting.profile:
+        yield
+        return
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        add(category, name, perf_counter() - start)
+
+def take():
+    """return and clear record; used to collect measurements of worker processes"""
+    result = {category: dict(entries) for category, entries in record.items()}
+    record.clear()
+    return result
+
+def merge(other):
+    """add measurements from another record"""
+    for category, entries in other.items():
+        for name, (count, seconds) in entries.items():
+            add(category, name, seconds, count)
+
+def report(size=10):
+    """write report in JSON form, log summary with the 'size' slowest pages and handlers"""
+    data = {category: {name: dict(count=count, seconds=round(seconds, 6))
+                       for name, (count, seconds) in entries.items()}
+            for category, entries in record.items()}
+    with open(setting.profile, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    logger.info(f'Profile written to {setting.profile}')
+    for name, (count, seconds) in record.get('phase', {}).items():
+        logger.info(f'{seconds:9.3f}s  phase {name}')
+    for category in ('converter', 'template', 'transformer'):
+        for name, (count, seconds) in sorted(record.get(category, {}).items()):
+            logger.info(f'{seconds:9.3f}s  {category} {name} ({count} calls)')
+    for category in ('page', 'handler'):
+        slowest = sorted(record.get(category, {}).items(), key=lambda item: -item[1][1])[:size]
+        for name, (count, seconds) in slowest:
+            logger.info(f'{seconds:9.3f}s  {category} {name} ({count} calls)')
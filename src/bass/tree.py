@@ -4,36 +4,152 @@ bass.tree
 Objects and functions related to the site tree.
 """
 
-import shutil, sys
+import pickle, sys
+from concurrent.futures import ThreadPoolExecutor
 from copy import copy as shallow_copy
-from os import makedirs
-from os.path import join, splitext
-from . import setting
-from .common import read_file, read_yaml_string, write_file, logger
-from .event import event
+from multiprocessing import get_context
+from os import stat
+from os.path import dirname, join, splitext
+from . import manifest, output, setting, timing
+from .cache import open_cache
+from .common import copy_file, hash_file, hash_string, read_file, read_yaml_string, logger
+from .event import Processor, event, event_handler, rewrite, subscribed
+from .layout import render_file
+from .timing import timer
+
+def copy_asset(source, target):
+    """default transformer: copy asset, unless the target is identical (see configuration
+       option 'asset_copy' for the copy method)"""
+    copy_file(source, target, setting.asset_copy)
 
 # available assets transformers
 transformer = {
-    '*': shutil.copy
+    '*': copy_asset
 }
 
+# version of cached transformers, with asset type as key; the results of these transformers are
+# kept in the 'transform' cache, with the content of the input, the version and the digest of
+# the extension (which usually defines the transformer) as key
+transformer_version = {}
+
 # More complicated examples:
 # - browserify vue/dist/vue.runtime.common.js > bundle.js
 # - browserify axios/index.js > bundle.js
 # - coffee -t -p index.coffee|cs > index.js
 
-def add_transformer(extension, transform):
-    """add transformer for asset type (extension)"""
+def add_transformer(extension, transform, version=None, cache=False):
+    """add transformer for asset type (extension); if 'cache' is true, results are cached, and
+       'version' (default: qualified name of transform) should change when the output does;
+       only use this for transformers whose output depends on nothing but the source file"""
     if callable(transform):
         if extension in transformer:
-            # do not use 'combine', since transformations are not by definition commutable
+            # do not chain transformers like event handlers, since transformations are not by definition commutable
             logger.debug(f'Attempt to redefine transformer for {extension}')
         else:
             logger.debug(f'New transformer for {extension}')
             transformer[extension] = transform
+            if cache:
+                transformer_version[extension] = version or \
+                    f'{transform.__module__}.{transform.__qualname__}'
     else:
         logger.debug(f'Transformer for {extension} is not a callable')
 
+def transform_asset(kind, source, target):
+    """apply transformer for asset type 'kind' to source file, write result to target file;
+       the result of a cached transformer is taken from the cache if possible"""
+    # the directory may still be waiting in the queue of the output thread pool
+    output.make_directory(dirname(target))
+    cache = open_cache('transform') if kind in transformer_version else None
+    if cache is None:
+        with timer('transformer', kind):
+            transformer[kind](source, target)
+        output.keep_file(target)
+        output.compress_file(target)
+        return
+    extension = manifest.digest.get('extension') or manifest.extension_digest()
+    key = hash_string(f'{kind}\n{transformer_version[kind]}\n{extension}\n{hash_file(source)}')
+    value = cache.get(key)
+    if value is None:
+        with timer('transformer', kind):
+            transformer[kind](source, target)
+        with open(target, 'rb') as f:
+            cache.put(key, f.read())
+    else:
+        logger.debug(f'Result of transformer for {target} found in cache')
+        with open(target, 'wb') as f:
+            f.write(value)
+    output.keep_file(target)
+    output.compress_file(target)
+
+# Assets with a transformer of the extension are transformed by a pool of threads, so that slow
+# transformers (usually external programs) do not hold up the rendering of the site tree; other
+# assets are copied immediately. The pool is started before rendering, and finished before the
+# post-render event of the root; see start_transformers and finish_transformers.
+transform_pool = None
+transform_futures = []
+
+def start_transformers(threads):
+    """start pool of 'threads' threads for asset transformers (no pool if threads < 2)"""
+    global transform_pool
+    if threads > 1:
+        transform_pool = ThreadPoolExecutor(threads, thread_name_prefix='bass-transform')
+
+def finish_transformers():
+    """wait until all assets have been transformed, stop thread pool"""
+    global transform_pool
+    if transform_pool is None:
+        return
+    try:
+        for future in transform_futures:
+            future.result() # re-raises exception of transformer
+    finally:
+        transform_pool.shutdown()
+        transform_pool = None
+        transform_futures.clear()
+
+# The pages of a site tree are indexed by id, tag and name, and all nodes by path. Every change
+# of the tree increases tree_version, so that the index is rebuilt when it is used next. Results
+# of Folder.pages are kept in the index as well.
+tree_version = 0
+
+def tree_changed():
+    """signal that nodes were added to the site tree, or that attributes of pages changed"""
+    global tree_version
+    tree_version += 1
+
+class Index:
+    """indexes of the nodes in a site tree, used by Folder.pages and Folder.node"""
+    def __init__(self, root):
+        """create index of the tree with the given root folder"""
+        self.version = tree_version
+        self.node = {}  # node with path as key
+        self.pages = [] # pages in tree order
+        self.order = {} # position of page in self.pages, with id(page) as key
+        self.span = {}  # range of positions of pages in sub-tree, with id(folder) as key
+        self.id = {}    # pages with id as key
+        self.tag = {}   # pages with tag as key
+        self.name = {}  # pages with name as key
+        self.query = {} # results of Folder.pages, with query as key
+        self.add(root)
+
+    def add(self, folder):
+        """add folder and its descendants to the index"""
+        first = len(self.pages)
+        self.node.setdefault(folder.path, folder)
+        for child in folder.children: # pages of this folder first, then sub-folders
+            self.node.setdefault(child.path, child)
+            if child.kind == 'Page':
+                self.order[id(child)] = len(self.pages)
+                self.pages.append(child)
+                self.id.setdefault(child.id, []).append(child)
+                self.name.setdefault(child.name, []).append(child)
+                for tag in child.tags:
+                    self.tag.setdefault(tag, []).append(child)
+        for child in folder.children:
+            if child.kind == 'Folder':
+                self.add(child)
+        self.span[id(folder)] = (first, len(self.pages))
+
 # node classes
 class Node:
     """Node is the base class for Folder, Page and Asset
@@ -46,9 +162,15 @@ class Node:
            - children: list of child nodes
 
        Instance methods:
-           - render: abstract method
+           - render: render node (pre-render events, write, children, post-render events)
+           - pre_render, outdated, write, post_render: steps of render
            - root: find root of tree
+
+       The instance variables are slots. Other attributes, such as the metadata of pages,
+       are stored in the instance dictionary.
     """
+    __slots__ = ('kind', 'id', 'name', 'path', 'parent', 'children', 'tags', '__dict__')
+
     def __init__(self, name, path, parent=None):
         """construct Node with given name, path and parent"""
         self.kind = 'Node'
@@ -64,7 +186,43 @@ class Node:
         pass
 
     def render(self):
-        """abstract render method"""
+        """render node: send pre-render event(s), write output if necessary,
+           render children, send post-render event(s)"""
+        self.pre_render()
+        if self.outdated():
+            self.write()
+        else:
+            self.compress()
+        for node in self.children:
+            node.render()
+        self.post_render()
+
+    def pre_render(self):
+        """abstract pre-render method"""
+        pass
+
+    def post_render(self):
+        """abstract post-render method"""
+        pass
+
+    def output_path(self):
+        """return path of node in output directory"""
+        return join(setting.output, setting.root_url[1:], self.path)
+
+    def compress(self):
+        """write compressed variants of existing output file, if they are not up to date"""
+        if setting.compress:
+            output.submit(output.compress_file, self.output_path())
+
+    def outdated(self):
+        """return True if output of node has to be written"""
+        if manifest.unchanged(self, self.output_path()):
+            logger.debug(f'{self.kind} {self.output_path()} is up to date')
+            return False
+        return True
+
+    def write(self):
+        """abstract write method"""
         pass
 
     def add(self, node):
@@ -81,16 +239,35 @@ class Node:
 
 
 class Folder(Node):
+    __slots__ = ('_child', '_index')
+
     def __init__(self, name, path, parent):
         """create new Folder node"""
         super().__init__(name, path, parent)
         self.kind = 'Folder'
+        self._index = None
+        self._child = None
+
+    def add(self, node):
+        """add child node"""
+        super().add(node)
+        tree_changed()
+
+    def _find(self, kind, name):
+        """return first child node of given kind with given name; the children are indexed by
+           kind and name, the index is rebuilt when the tree has changed"""
+        version = (tree_version, len(self.children))
+        if self._child is None or self._child[0] != version:
+            child = {'Folder': {}, 'Page': {}, 'Asset': {}}
+            for node in self.children:
+                if node.kind in child:
+                    child[node.kind].setdefault(node.name, node)
+            self._child = (version, child)
+        return self._child[1][kind].get(name)
 
     def asset(self, name):
         """return asset node with given name in this folder"""
-        matches = [child for child in self.children
-                   if child.name == name and child.kind == 'Asset']
-        return matches[0] if matches else None
+        return self._find('Asset', name)
 
     def assets(self):
         """return all asset nodes in this folder"""
@@ -98,9 +275,7 @@ class Folder(Node):
 
     def folder(self, name):
         """return folder node with given name in this folder"""
-        matches = [child for child in self.children
-                   if child.name == name and child.kind == 'Folder']
-        return matches[0] if matches else None
+        return self._find('Folder', name)
 
     def folders(self):
         """return all folder nodes in this folder"""
@@ -108,53 +283,146 @@ class Folder(Node):
 
     def page(self, name):
         """return page node with given name in this folder"""
-        matches = [child for child in self.children
-                   if child.name == name and child.kind == 'Page']
-        return matches[0] if matches else None
-
-    def _pages(self, deep=False):
-        result = [node for node in self.children if node.kind == 'Page']
-        if deep:
-            for f in self.folders():
-                result.extend(f._pages(deep=True))
-        return result
-
-    def pages(self, tag=None, idref=None, deep=False, key='name'):
-        """return page nodes with given tag in this folder"""
-        result = self._pages(deep=deep)
-        if tag:
-            result = [node for node in result if tag in node.tags]
-        elif idref:
-            result = [node for node in result if idref == node.id]
-        return sorted(result, key=lambda page: getattr(page, key))
+        return self._find('Page', name)
+
+    def node(self, path):
+        """return node with given path in the tree of which this folder is part, or None"""
+        return self.root().index().node.get(path)
+
+    def index(self):
+        """return index of the tree of which this folder is the root"""
+        if self._index is None or self._index.version != tree_version:
+            self._index = Index(self)
+        return self._index
+
+    def pages(self, tag=None, idref=None, deep=False, key='name', name=None):
+        """return page nodes with given tag, id or name in this folder,
+           and in its sub-folders if 'deep' is True"""
+        index = self.root().index()
+        query = (id(self), tag, idref, name, deep, key)
+        if query not in index.query:
+            if deep:
+                if tag:
+                    result = index.tag.get(tag, [])
+                elif idref:
+                    result = index.id.get(idref, [])
+                elif name:
+                    result = index.name.get(name, [])
+                else:
+                    result = index.pages
+                if self.parent is not None: # restrict to pages in this sub-tree
+                    first, last = index.span[id(self)]
+                    result = [node for node in result if first <= index.order[id(node)] < last]
+            else:
+                result = [node for node in self.children if node.kind == 'Page']
+                if tag:
+                    result = [node for node in result if tag in node.tags]
+                elif idref:
+                    result = [node for node in result if idref == node.id]
+                elif name:
+                    result = [node for node in result if name == node.name]
+            index.query[query] = sorted(result, key=lambda page: getattr(page, key))
+        return list(index.query[query])
 
     def ready(self):
         """folder is ready: send event(s)"""
+        tree_changed() # pages may have new tags or ids
         event('generate:post:root' if self.name == '' else 'generate:post:folder:path:'+self.path, self)
+        tree_changed() # and handlers may have changed them
 
-    def render(self):
-        """render folder"""
+    def pre_render(self):
+        """send pre-render event(s), create directory"""
         event('render:pre:root' if self.name == '' else 'render:pre:folder:path:'+self.path, self)
-        if self.name != '': # root -> output directory, which already exists
-            # rendering a folder means: create sub-directory 'self.path' in output directory
-            dirpath = join(setting.output, setting.root_url[1:], self.path)
+        # rendering a folder means: create sub-directory 'self.path' in output directory
+        dirpath = self.output_path()
+        if self.name != '':
             logger.debug(f"Creating directory {dirpath}")
-            makedirs(dirpath)
-        for node in self.children:
-            node.render()
-        event('render:post:root' if self.name == '' else 'render:post:folder:path:'+self.path, self)
+            output.submit(output.make_directory, dirpath)
+            manifest.add_folder(self, dirpath)
+        else: # root -> output directory (plus root URL), which may already exist
+            output.submit(output.make_directory, dirpath)
+
+    def outdated(self):
+        """directory has already been created"""
+        return False
+
+    def compress(self):
+        """directories are not compressed"""
+        pass
+
+    def post_render(self):
+        """send post-render event(s); render:post:root is the last event of the build, so all
+           pending transformations and writes are finished before it is sent"""
+        if self.name == '':
+            finish_transformers()
+            output.finish_output()
+            event('render:post:root', self)
+        else:
+            event('render:post:folder:path:'+self.path, self)
 
 
 class Page(Node):
-    def __init__(self, name, path, parent):
-        """create new Page node; set content, preview and meta attributes"""
+    __slots__ = ('skin', 'url', 'meta', 'source', 'processor', 'converted', '_preview', '_content')
+
+    def __init__(self, name, path, parent, prepared=None):
+        """create new Page node; set content, preview and meta attributes, from 'prepared'
+           (result of prepare_page) if given"""
         super().__init__(name, path, parent)
         self.kind = 'Page'
         # attributes 'skin' and 'url' are derived from metadata by the page processor
         self.skin = ''
         self.url = ''
-        full_path = join(setting.input, path)
-        self.meta, self.preview, self.content = read_page(full_path)
+        self.source = join(setting.input, path)
+        # in lazy mode, the page processor stores itself in this attribute
+        self.processor = None
+        # name of the page processor that already converted preview and content
+        self.converted = None
+        if prepared is not None:
+            self.meta, self._preview, self._content, self.converted = prepared
+        elif setting.lazy: # only keep metadata
+            self.meta = read_meta(self.source)
+            self._preview, self._content = None, None
+        else:
+            self.meta, self._preview, self._content = read_page(self.source)
+
+    @property
+    def preview(self):
+        """preview of page; in lazy mode, read and converted when needed"""
+        if self._preview is None:
+            self.load()
+        return self._preview
+
+    @preview.setter
+    def preview(self, value):
+        self._preview = value
+
+    @property
+    def content(self):
+        """content of page; in lazy mode, read and converted when needed"""
+        if self._content is None:
+            self.load()
+        return self._content
+
+    @content.setter
+    def content(self, value):
+        self._content = value
+
+    def loaded(self):
+        """return True if preview and content are in memory"""
+        return self._content is not None
+
+    def load(self):
+        """read preview and content from file, convert them with the page processor"""
+        logger.debug(f'Loading page {self.path}')
+        _, self._preview, self._content = read_page(self.source)
+        if self.processor is not None:
+            self.processor.convert_node(self)
+            self.converted = self.processor.name
+
+    def release(self):
+        """in lazy mode, release preview and content, if they can be loaded again"""
+        if setting.lazy and self.processor is not None:
+            self._preview, self._content, self.converted = None, None, None
 
     def copy(self, sep='_'):
         """create copy of page node, with its own name, path and URL, and empty children list"""
@@ -172,30 +440,43 @@ class Page(Node):
         event('generate:post:page:path:'+self.path, self)
         event('generate:post:page:extension:'+suffix, self)
 
-    def render(self):
-        """render Page node"""
+    def pre_render(self):
+        """send pre-render event(s), check template"""
         event('render:pre:page:any', self)
         event('render:pre:page:name:' + self.name, self)
         if self.id: event('render:pre:page:id:'+self.id, self)
-        for tag in self.tags: event('render:pre:page:tag:'+tag, self)
+        if subscribed('render:pre:page:tag:'):
+            for tag in self.tags: event('render:pre:page:tag:'+tag, self)
+        rewrite(self) # rewriters selected by the events
         # 'skin' attribute should be set by page processor
-        if self.skin in setting.template:
-            template = setting.template[self.skin]
-        else:
+        if self.skin not in setting.template:
             logger.critical(f"Template '{self.skin}' for page {self.path} not available.")
             sys.exit(1)
-        filepath = join(setting.output, self.url[1:])
+
+    def output_path(self):
+        """return path of HTML page in output directory"""
+        return join(setting.output, self.url[1:])
+
+    def write(self):
+        """render content as HTML page, write HTML page"""
+        filepath = self.output_path()
         logger.debug('Writing page {}'.format(filepath))
-        write_file(template.render(this=self), filepath)
-        for node in self.children: # (dynamically created) sub-pages
-            node.render()
+        with timer('page', self.path), timer('template', self.skin):
+            render_file(setting.template[self.skin], filepath, this=self)
+
+    def post_render(self):
+        """send post-render event(s)"""
         event('render:post:page:any', self)
         event('render:post:page:name:' + self.name, self)
         if self.id: event('render:post:page:id:'+self.id, self)
-        for tag in self.tags: event('render:post:page:tag:'+tag, self)
+        if subscribed('render:post:page:tag:'):
+            for tag in self.tags: event('render:post:page:tag:'+tag, self)
+        self.release()
 
 
 class Asset(Node):
+    __slots__ = ('url',)
+
     def __init__(self, name, path, parent):
         """create new Asset node"""
         super().__init__(name, path, parent)
@@ -208,18 +489,120 @@ class Asset(Node):
         event('generate:post:asset:name:'+self.name, self)
         event('generate:post:asset:extension:'+suffix, self)
 
-    def render(self):
-        """render Asset node"""
+    def pre_render(self):
+        """send pre-render event(s)"""
         suffix = splitext(self.path)[1][1:]
         event('render:pre:asset:name:'+self.name, self)
         event('render:pre:asset:extension:'+suffix, self)
-        output_path = join(setting.output, setting.root_url[1:], self.path)
+
+    def write(self):
+        """transform (copy) file from input to output directory"""
+        suffix = splitext(self.path)[1][1:]
+        output_path = self.output_path()
         logger.debug(f'Writing asset {output_path}')
-        transform = transformer[suffix] if suffix in transformer else transformer['*']
-        transform(join(setting.input, self.path), output_path)
+        kind = suffix if suffix in transformer else '*'
+        if transform_pool is None or kind == '*': # copying is not worth a thread
+            transform_asset(kind, join(setting.input, self.path), output_path)
+        else:
+            transform_futures.append(transform_pool.submit(transform_asset, kind,
+                                                           join(setting.input, self.path), output_path))
+
+    def post_render(self):
+        """send post-render event(s)"""
+        suffix = splitext(self.path)[1][1:]
         event('render:post:asset:name:'+self.name, self)
         event('render:post:asset:extension:'+suffix, self)
 
+# Parallel rendering: the site tree is traversed twice. The first traversal sends the pre-render
+# events and collects the nodes of which the output has to be written. These are written by a
+# pool of worker processes, which are forked after the first traversal and therefore inherit the
+# complete site tree. The second traversal sends the post-render events.
+
+# tasks for the worker processes: write methods of the nodes of which the output has to be
+# written, and compress methods of the other nodes (if compression is enabled)
+write_queue = []
+
+def write_node(index):
+    """perform task with given index in the write queue (called in worker process);
+       return measurements if profiling is enabled"""
+    write_queue[index]()
+    return timing.take() if setting.profile else None
+
+def render_parallel(root, jobs):
+    """render site tree, writing pages and assets in 'jobs' worker processes"""
+    def pre(node):
+        node.pre_render()
+        if node.outdated():
+            write_queue.append(node.write)
+        elif setting.compress and node.kind != 'Folder':
+            write_queue.append(node.compress)
+        for child in node.children:
+            pre(child)
+    def post(node):
+        for child in node.children:
+            post(child)
+        node.post_render()
+    write_queue.clear()
+    pre(root)
+    logger.info(f'Writing {len(write_queue)} files with {jobs} processes')
+    with get_context('fork').Pool(jobs, initializer=timing.record.clear) as pool:
+        for measurements in pool.imap_unordered(write_node, range(len(write_queue)),
+                                                chunksize=max(1, len(write_queue)//(4*jobs))):
+            if measurements:
+                timing.merge(measurements)
+    write_queue.clear()
+    post(root)
+
+def prepare_page(source, suffix):
+    """read page and convert preview and content with the page processor for its type (called in
+       worker process, see site.generate_tree); return (meta, preview, content, name of processor),
+       and measurements if profiling is enabled; the page is not converted if there are handlers
+       for generate:post:page:path events, which are sent before the page processor is called"""
+    if setting.lazy:
+        result = read_meta(source), None, None, None
+    else:
+        meta, preview, content = read_page(source)
+        handlers = event_handler.get('generate:post:page:extension:'+suffix, [])
+        processor = handlers[0] if handlers and isinstance(handlers[0], Processor) else None
+        if subscribed('generate:post:page:path:'): # these handlers see the page before conversion
+            processor = None
+        if processor is not None and processor.convert:
+            preview = processor.cached_convert(preview) if preview else ''
+            content = processor.cached_convert(content)
+            result = meta, preview, content, processor.name
+        else:
+            result = meta, preview, content, None
+    return result, (timing.take() if setting.profile else None)
+
+def read_meta(path):
+    """read metadata of page from file: only the lines up to the first divider are read"""
+    if setting.meta_cache:
+        cache = open_cache('meta')
+        if cache is not None:
+            info = stat(path)
+            key = hash_string(f'{path}\n{info.st_mtime_ns}\n{info.st_size}')
+            value = cache.get(key)
+            if value is not None:
+                return pickle.loads(value)
+            meta = read_header(path)
+            cache.put(key, pickle.dumps(meta))
+            return meta
+    return read_header(path)
+
+def read_header(path):
+    """read lines up to the first divider, return metadata"""
+    lines = []
+    with open(path, 'r') as f:
+        try:
+            for n, line in enumerate(f):
+                if line == '---\n' and n > 0:
+                    # the newline before the divider is part of the divider
+                    return read_yaml_string(''.join(lines)[:-1]) or {}
+                lines.append(line)
+        except UnicodeError:
+            logger.debug(f'Unicode error in file {path}')
+    return {} # no metadata
+
 def read_page(path):
     """read page from file and return triple (meta, preview, content)"""
     text = read_file(path)
@@ -227,8 +610,8 @@ def read_page(path):
     if len(parts) == 1: # no metadata, just content
         return {}, '', parts[0]
     elif len(parts) == 2: # metadata, content
-        meta = read_yaml_string(parts[0])
+        meta = read_yaml_string(parts[0]) or {}
         return meta, '', parts[1]
     else: # len(parts) > 2 -> metadata, preview, content
-        meta = read_yaml_string(parts[0])
+        meta = read_yaml_string(parts[0]) or {}
         return meta, parts[1], '\n'.join(parts[1:])
@@ -0,0 +1,148 @@
+"""
+bass.watch
+-----
+Objects and functions for watching directories for changes, used by the development server.
+
+A watcher runs in a background thread and collects the paths of files that have been created,
+modified or removed. On Linux the inotify interface of the kernel is used, on other systems the
+directories are scanned periodically.
+"""
+
+import ctypes, ctypes.util, struct
+from os import read, walk
+from os.path import getmtime, join
+from threading import Condition, Thread
+from time import monotonic, sleep
+from . import setting
+from .common import logger
+
+class Watcher:
+    """base class for watchers: collect changed paths in the given directories"""
+    def __init__(self, directories, delay=0.2):
+        """create watcher; bursts of changes less than 'delay' seconds apart are coalesced"""
+        self.directories = directories
+        self.delay = delay
+        self.changed = set()
+        self.last = 0.0 # time of last change
+        self.condition = Condition()
+
+    def start(self):
+        """start watching in background thread"""
+        Thread(target=self.run, name='bass-watcher', daemon=True).start()
+
+    def run(self):
+        """abstract method: watch directories, call self.notify for every changed path"""
+        pass
+
+    def notify(self, path):
+        """register changed path"""
+        with self.condition:
+            self.changed.add(path)
+            self.last = monotonic()
+            self.condition.notify_all()
+
+    def pending(self):
+        """True if there are changes that have not been collected yet"""
+        return bool(self.changed)
+
+    def changes(self, timeout=None):
+        """wait until there are changes (at most 'timeout' seconds) and until there have been
+           no new changes for self.delay seconds, return and reset set of changed paths"""
+        with self.condition:
+            if not self.changed:
+                self.condition.wait(timeout)
+            while self.changed and monotonic() - self.last < self.delay:
+                self.condition.wait(self.delay - (monotonic() - self.last))
+            result, self.changed = self.changed, set()
+        return result
+
+
+class PollingWatcher(Watcher):
+    """watcher that scans the directories periodically"""
+    def __init__(self, directories, delay=0.2, interval=1.0):
+        super().__init__(directories, delay)
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def scan(self):
+        """return modification times of all files, with path as key"""
+        result = {}
+        for directory in self.directories:
+            for dirpath, _, filenames in walk(directory, followlinks=setting.follow_links):
+                for name in filenames:
+                    path = join(dirpath, name)
+                    try:
+                        result[path] = getmtime(path)
+                    except OSError: # removed in the meantime
+                        pass
+        return result
+
+    def run(self):
+        while True:
+            sleep(self.interval)
+            snapshot = self.scan()
+            for path in snapshot.keys() | self.snapshot.keys():
+                if snapshot.get(path) != self.snapshot.get(path):
+                    self.notify(path)
+            self.snapshot = snapshot
+
+
+class InotifyWatcher(Watcher):
+    """watcher that uses the inotify interface of the Linux kernel"""
+    # constants from <sys/inotify.h>
+    IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE = 0x002, 0x004, 0x008
+    IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x040, 0x080, 0x100, 0x200
+    IN_Q_OVERFLOW, IN_ISDIR, IN_CLOEXEC = 0x4000, 0x40000000, 0o2000000
+    mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    header = struct.Struct('iIII') # wd, mask, cookie, len
+
+    def __init__(self, directories, delay=0.2):
+        super().__init__(directories, delay)
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.wd = {} # watched directory, with watch descriptor as key
+        for directory in directories:
+            self.add_tree(directory)
+
+    def add_tree(self, directory):
+        """watch directory and all its sub-directories"""
+        for dirpath, _, _ in walk(directory, followlinks=setting.follow_links):
+            wd = self.libc.inotify_add_watch(self.fd, dirpath.encode(), self.mask)
+            if wd < 0:
+                logger.debug(f'Cannot watch directory {dirpath}')
+            else:
+                self.wd[wd] = dirpath
+
+    def run(self):
+        while True:
+            buffer = read(self.fd, 65536)
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, _, length = self.header.unpack_from(buffer, offset)
+                offset += self.header.size
+                name = buffer[offset:offset+length].rstrip(b'\0').decode(errors='replace')
+                offset += length
+                if mask & self.IN_Q_OVERFLOW: # events lost: report directories as changed
+                    for directory in self.directories:
+                        self.notify(directory)
+                    continue
+                if wd not in self.wd:
+                    continue
+                path = join(self.wd[wd], name)
+                if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    self.add_tree(path)
+                self.notify(path)
+
+
+def watcher(directories):
+    """create and start watcher for the given directories"""
+    try:
+        result = InotifyWatcher(directories)
+        logger.debug('Watching directories with inotify')
+    except (AttributeError, OSError, TypeError):
+        result = PollingWatcher(directories)
+        logger.debug('Watching directories by polling')
+    result.start()
+    return result
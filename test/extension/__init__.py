@@ -1,13 +1,8 @@
-from bass import add_handler, resolve_idref, logger
+from bass import add_handler, add_rewriter, resolve_idref, logger
 
-logger.info('Define function table_class as extension')
-def table_class(this):
-    logger.debug('render:pre:page:tag:table called for page %s', this.name)
-    this.content = this.content.replace('<table>', '<table class="table">')\
-                               .replace('class="docutils"', 'class="table"')\
-                               .replace('border="1"', '')
-
-logger.info('Add handler table_class as extension')
-add_handler('render:pre:page:tag:table', table_class)
+logger.info('Add rewriters for tables as extension')
+add_rewriter('render:pre:page:tag:table', '<table>', '<table class="table">')
+add_rewriter('render:pre:page:tag:table', 'class="docutils"', 'class="table"')
+add_rewriter('render:pre:page:tag:table', 'border="1"', '')
 logger.info('Add handler resolve_idref as extension')
 add_handler('render:pre:page:any',       resolve_idref)